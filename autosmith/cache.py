@@ -0,0 +1,76 @@
+import hashlib
+import json
+import os
+import threading
+from pathlib import Path
+from typing import Dict, Optional
+
+from pydantic import BaseModel
+
+_lock = threading.Lock()
+
+# directory for on-disk caches of derived data (None keeps them in memory only)
+_cache_dir: Optional[Path] = (
+    Path(os.environ["AUTOSMITH_CACHE_DIR"])
+    if os.environ.get("AUTOSMITH_CACHE_DIR")
+    else None
+)
+
+
+def get_cache_dir() -> Optional[Path]:
+    """Get the directory for on-disk caches, set by set_cache_dir or $AUTOSMITH_CACHE_DIR"""
+    return _cache_dir
+
+
+def set_cache_dir(path: Optional[Path]):
+    """Set the directory for on-disk caches, or None to disable them"""
+    global _cache_dir
+    _cache_dir = None if path is None else Path(path)
+
+
+def artifact_hash(*artifacts: str) -> str:
+    """Hash rendered artifacts (Dockerfile, requirements.txt, main.py) into a digest"""
+    h = hashlib.sha256()
+    for artifact in artifacts:
+        data = artifact.encode("utf-8")
+        # length prefix so that artifact boundaries are part of the hash
+        h.update(len(data).to_bytes(8, "big"))
+        h.update(data)
+    return h.hexdigest()
+
+
+class ImageCache(BaseModel):
+    """Local index of built images, keyed by the hash of their rendered artifacts
+
+    Entries whose image no longer exists are rebuilt (and overwritten) on use.
+    """
+
+    path: Path = Path.home() / ".autosmith" / "images.json"
+
+    def _read(self) -> Dict[str, str]:
+        if not self.path.exists():
+            return {}
+        try:
+            with open(self.path, "r") as f:
+                return json.load(f)
+        except json.JSONDecodeError:
+            return {}
+
+    def _write(self, index: Dict[str, str]):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.path.with_suffix(f".{os.getpid()}.tmp")
+        with open(tmp, "w") as f:
+            json.dump(index, f, indent=2, sort_keys=True)
+        os.replace(tmp, self.path)
+
+    def get(self, digest: str) -> Optional[str]:
+        """Get the image built from artifacts with this digest, if any"""
+        with _lock:
+            return self._read().get(digest)
+
+    def add(self, digest: str, image: str):
+        """Record that image was built from artifacts with this digest"""
+        with _lock:
+            index = self._read()
+            index[digest] = image
+            self._write(index)
@@ -0,0 +1,395 @@
+import contextlib
+import http.client
+import io
+import itertools
+import json
+import sys
+import threading
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import Future
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from pydantic import BaseModel
+
+from .runtime import Runtime
+
+
+def parse_metrics(text: str) -> List[Tuple[str, Dict[str, str], float]]:
+    """Parse samples from the Prometheus text format into (name, labels, value)"""
+    samples = []
+    for line in text.splitlines():
+        if not line or line.startswith("#"):
+            continue
+        name_labels, value = line.rsplit(" ", 1)
+        labels: Dict[str, str] = {}
+        name = name_labels
+        if "{" in name_labels:
+            name, rest = name_labels.split("{", 1)
+            for pair in rest.rstrip("}").split(","):
+                if pair:
+                    key, label = pair.split("=", 1)
+                    labels[key] = label.strip('"')
+        samples.append((name, labels, float(value)))
+    return samples
+
+
+MSGPACK = "application/msgpack"
+NPY = "application/x-npy"
+NDJSON = "application/x-ndjson"
+# msgpack extension type of numpy arrays, packed as [dtype, shape, raw buffer]
+_NDARRAY_EXT = 1
+
+
+def _msgpack():
+    try:
+        import msgpack
+    except ImportError:
+        raise ValueError("msgpack encoding needs msgpack installed")
+    return msgpack
+
+
+def _to_builtin(obj: Any) -> Any:
+    """JSON and msgpack fallback for models and numpy values"""
+    if isinstance(obj, BaseModel):
+        return obj.dict()
+    # numpy values can only exist if the caller imported numpy
+    numpy = sys.modules.get("numpy")
+    if numpy is not None:
+        if isinstance(obj, numpy.ndarray):
+            return obj.tolist()
+        if isinstance(obj, numpy.generic):
+            return obj.item()
+    raise TypeError(f"Cannot encode {type(obj).__name__}")
+
+
+def _msgpack_default(obj: Any) -> Any:
+    numpy = sys.modules.get("numpy")
+    if (
+        numpy is not None
+        and isinstance(obj, numpy.ndarray)
+        and obj.dtype.kind in "biufc"
+    ):
+        msgpack = _msgpack()
+        obj = numpy.ascontiguousarray(obj)
+        return msgpack.ExtType(
+            _NDARRAY_EXT, msgpack.packb([obj.dtype.str, obj.shape, obj.data])
+        )
+    return _to_builtin(obj)
+
+
+def _msgpack_ext(code: int, data: bytes) -> Any:
+    msgpack = _msgpack()
+    if code != _NDARRAY_EXT:
+        return msgpack.ExtType(code, data)
+    import numpy
+
+    dtype, shape, buffer = msgpack.unpackb(data)
+    return numpy.frombuffer(buffer, dtype=dtype).reshape(shape)
+
+
+def encode_body(input: Any, encoding: str = "json") -> Tuple[bytes, str]:
+    """Encode input as "json" or "msgpack", returning the body and its content type
+
+    With msgpack, numeric numpy arrays are sent as their raw buffer; with JSON
+    they are sent as nested lists.
+    """
+    if encoding == "json":
+        return (
+            json.dumps(input, default=_to_builtin).encode("utf-8"),
+            "application/json",
+        )
+    if encoding == "msgpack":
+        return _msgpack().packb(input, default=_msgpack_default), MSGPACK
+    raise ValueError(f"Unknown encoding {encoding}")
+
+
+def decode_body(data: bytes, content_type: str) -> Any:
+    """Decode a response by its content type (JSON, msgpack or .npy)
+
+    Arrays decoded from msgpack are read-only views of the response.
+    """
+    content_type = content_type.split(";")[0].strip()
+    if content_type == MSGPACK:
+        return _msgpack().unpackb(data, ext_hook=_msgpack_ext)
+    if content_type == NPY:
+        import numpy
+
+        return numpy.load(io.BytesIO(data), allow_pickle=False)
+    return json.loads(data)
+
+
+class RPCClient:
+    """Calls tools over one WebSocket connection to /_rpc of a replica (ToolEnv(rpc=True))
+
+    Calls from any number of threads share the connection; each gets a request id
+    and replies are matched to calls by it, so they may arrive in any order.
+    Needs websockets installed. For asyncio, wrap submit with asyncio.wrap_future.
+    """
+
+    def __init__(self, url: str, encoding: str = "json"):
+        try:
+            from websockets.sync.client import connect
+        except ImportError:
+            raise ValueError("RPC needs websockets installed")
+        if encoding not in ("json", "msgpack"):
+            raise ValueError(f"Unknown encoding {encoding}")
+        self.encoding = encoding
+        self._exit_stack = contextlib.ExitStack()
+        self._connection = self._exit_stack.enter_context(connect(url, max_size=None))
+        self._ids = itertools.count()
+        self._pending: Dict[int, Future] = {}
+        self._lock = threading.Lock()
+        self._closed = False
+        self._reader = threading.Thread(target=self._read, daemon=True)
+        self._reader.start()
+
+    def submit(self, endpoint: str, input: Dict[str, Any]) -> Future:
+        """Send a call, returning a future of its result"""
+        future: Future = Future()
+        with self._lock:
+            if self._closed:
+                raise ValueError("RPC connection is closed")
+            call_id = next(self._ids)
+            self._pending[call_id] = future
+            call = {"id": call_id, "tool": endpoint, "input": input}
+            if self.encoding == "msgpack":
+                self._connection.send(encode_body(call, "msgpack")[0])
+            else:
+                self._connection.send(json.dumps(call, default=_to_builtin))
+        return future
+
+    def call(self, endpoint: str, **kwargs) -> Any:
+        """Call a tool and wait for its result, raising ValueError if it failed"""
+        return self.submit(endpoint, kwargs).result()
+
+    def _read(self):
+        from websockets.exceptions import ConnectionClosed
+
+        try:
+            for data in self._connection:
+                if isinstance(data, bytes):
+                    message = decode_body(data, MSGPACK)
+                else:
+                    message = json.loads(data)
+                with self._lock:
+                    future = self._pending.pop(message.get("id"), None)
+                if future is None:
+                    continue
+                if "error" in message:
+                    error = message["error"]
+                    future.set_exception(
+                        ValueError(f"{error['status']}: {error['detail']}")
+                    )
+                else:
+                    future.set_result(message.get("result"))
+        except ConnectionClosed:
+            pass
+        finally:
+            with self._lock:
+                self._closed = True
+                pending, self._pending = self._pending, {}
+            for future in pending.values():
+                future.set_exception(ValueError("RPC connection closed"))
+
+    def close(self):
+        self._exit_stack.close()
+        self._reader.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class Replica(BaseModel):
+    """Replica is one running container of a tool environment"""
+
+    container_id: str
+    port: int
+
+
+class ToolClient:
+    """Client that spreads tool calls round-robin across the replicas of a ToolEnv
+
+    Replicas that cannot be reached and are no longer running are dropped.
+    """
+
+    def __init__(self, host: str, replicas: List[Replica], docker: Runtime):
+        self.host = host
+        self.replicas = list(replicas)
+        self.docker = docker
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
+
+    def url(self, replica: Replica) -> str:
+        return f"http://{self.host}:{replica.port}"
+
+    def _next(self) -> Replica:
+        with self._lock:
+            if not self.replicas:
+                raise ValueError("No replicas running")
+            return self.replicas[next(self._counter) % len(self.replicas)]
+
+    def _drop(self, replica: Replica):
+        with self._lock:
+            if replica in self.replicas:
+                self.replicas.remove(replica)
+
+    def healthy(self) -> List[Replica]:
+        """Drop replicas that are no longer running and return the rest"""
+        for replica in list(self.replicas):
+            if not self.docker.is_running(replica.container_id):
+                self._drop(replica)
+        return list(self.replicas)
+
+    def request(
+        self,
+        path: str,
+        data: Optional[bytes] = None,
+        headers: Optional[Dict[str, str]] = None,
+    ):
+        """Send a request to the next replica, failing over to the others
+
+        Returns the open response; http errors from the tool are raised as is.
+        """
+        while True:
+            replica = self._next()
+            req = urllib.request.Request(
+                self.url(replica) + path, data=data, headers=headers or {}
+            )
+            try:
+                return urllib.request.urlopen(req)
+            except urllib.error.HTTPError:
+                raise
+            except (urllib.error.URLError, ConnectionError):
+                if self.docker.is_running(replica.container_id):
+                    raise
+                self._drop(replica)
+
+    def call(self, endpoint: str, **kwargs) -> Any:
+        """Call a tool by its endpoint with query arguments and decode the JSON result"""
+        query = urllib.parse.urlencode(kwargs, doseq=True)
+        with self.request(f"/{endpoint}?{query}" if query else f"/{endpoint}") as r:
+            return json.loads(r.read())
+
+    def post(
+        self,
+        endpoint: str,
+        input: Dict[str, Any],
+        encoding: str = "json",
+        accept: Optional[str] = None,
+    ) -> Any:
+        """Call a tool with its input in the body, encoded as "json" or "msgpack"
+
+        The result is requested in the same encoding, unless accept gives another
+        content type (e.g. NPY for tools returning one numpy array).
+        """
+        data, content_type = encode_body(input, encoding)
+        with self.request(
+            f"/{endpoint}",
+            data=data,
+            headers={"Content-Type": content_type, "Accept": accept or content_type},
+        ) as r:
+            return decode_body(r.read(), r.headers.get("Content-Type", ""))
+
+    def stream(
+        self, endpoint: str, input: Dict[str, Any], encoding: str = "json"
+    ) -> Iterator[Any]:
+        """Call a streaming (generator) tool, yielding its results as they arrive
+
+        Results come as NDJSON, or as msgpack if encoding is "msgpack". Raises
+        ValueError if the stream ends early because the tool failed.
+        """
+        data, content_type = encode_body(input, encoding)
+        accept = MSGPACK if encoding == "msgpack" else NDJSON
+        with self.request(
+            f"/{endpoint}",
+            data=data,
+            headers={"Content-Type": content_type, "Accept": accept},
+        ) as r:
+            unpacker = None
+            if r.headers.get("Content-Type", "").startswith(MSGPACK):
+                unpacker = _msgpack().Unpacker(ext_hook=_msgpack_ext)
+            buffer = b""
+            while True:
+                # read1 returns what has arrived and, unlike readline, raises
+                # if the connection drops before the response ends
+                try:
+                    chunk = r.read1(65536)
+                except http.client.IncompleteRead:
+                    raise ValueError(f"Stream of {endpoint} ended early")
+                if not chunk:
+                    break
+                if unpacker is not None:
+                    unpacker.feed(chunk)
+                    yield from unpacker
+                    continue
+                *lines, buffer = (buffer + chunk).split(b"\n")
+                for line in lines:
+                    yield json.loads(line)
+            if buffer.strip():
+                yield json.loads(buffer)
+
+    def rpc(self, encoding: str = "json") -> RPCClient:
+        """Open a WebSocket to the next replica for many calls over one connection"""
+        replica = self._next()
+        return RPCClient(f"ws://{self.host}:{replica.port}/_rpc", encoding)
+
+    def batch(self, endpoint: str, inputs: List[Dict[str, Any]]) -> List[Any]:
+        """Call a tool on many inputs in one request, returning results in order"""
+        data = json.dumps(inputs).encode("utf-8")
+        with self.request(
+            f"/{endpoint}/batch",
+            data=data,
+            headers={"Content-Type": "application/json"},
+        ) as r:
+            return json.loads(r.read())
+
+    def cache_stats(self) -> Dict[str, Dict[str, int]]:
+        """Result cache counters of each cached tool, summed over all replicas"""
+        totals: Dict[str, Dict[str, int]] = {}
+        for replica in list(self.replicas):
+            with urllib.request.urlopen(self.url(replica) + "/_cache") as r:
+                stats = json.loads(r.read())
+            for endpoint, counters in stats.items():
+                total = totals.setdefault(endpoint, {})
+                for name, value in counters.items():
+                    total[name] = total.get(name, 0) + value
+        return totals
+
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        """Scrape /metrics of every replica, summing the samples of each tool
+
+        Keys are the metric names without the "autosmith_tool_" prefix, e.g.
+        requests_total, errors_total, in_flight, exec_seconds_sum, exec_seconds_count.
+        Histogram buckets are left out.
+        """
+        totals: Dict[str, Dict[str, float]] = {}
+        for replica in list(self.replicas):
+            with urllib.request.urlopen(self.url(replica) + "/metrics") as r:
+                text = r.read().decode("utf-8")
+            for name, labels, value in parse_metrics(text):
+                if not name.startswith("autosmith_tool_") or name.endswith("_bucket"):
+                    continue
+                total = totals.setdefault(labels["tool"], {})
+                key = name[len("autosmith_tool_") :]
+                total[key] = total.get(key, 0.0) + value
+        return totals
+
+    def add_tool(self, endpoint: str, code: str, token: str):
+        """Register a rendered tool on every replica without restarting it"""
+        data = json.dumps({"endpoint": endpoint, "code": code}).encode("utf-8")
+        for replica in list(self.replicas):
+            req = urllib.request.Request(
+                self.url(replica) + "/_admin/tools",
+                data=data,
+                headers={
+                    "Content-Type": "application/json",
+                    "X-Autosmith-Token": token,
+                },
+            )
+            with urllib.request.urlopen(req):
+                pass
@@ -1,17 +1,29 @@
 import subprocess
 from pathlib import Path
-from typing import Optional
+from typing import Callable, Dict, Literal, Optional
 
-from pydantic import BaseModel, validator
+from pydantic import validator
 
+from .engine import DockerEngine, get_engine
+from .runtime import Runtime
 
-class Docker(BaseModel):
+
+class Docker(Runtime):
+    # "cli" runs the docker command, "api" talks to the engine over its unix socket
+    backend: Literal["cli", "api"] = "cli"
+    socket: Path = Path("/var/run/docker.sock")
     mock: Optional[bool] = False
 
     @validator("mock")
-    def docker_must_be_installed(cls, v):
+    def docker_must_be_installed(cls, v, values):
         if v:
             return v
+        if values.get("backend") == "api":
+            if values.get("socket") and values["socket"].exists():
+                return v
+            if v is None:
+                return True
+            raise ValueError("Docker socket must exist")
         try:
             subprocess.run(["docker", "--version"], capture_output=True)
         except FileNotFoundError:
@@ -20,9 +32,15 @@ class Docker(BaseModel):
             raise ValueError("Docker must be installed")
         return v
 
+    @property
+    def engine(self) -> DockerEngine:
+        return get_engine(self.socket)
+
     def remove_image(self, image_name: str):
         if self.mock:
             return
+        if self.backend == "api":
+            return self.engine.remove_image(image_name)
         # remove old containers with same image name
         output = subprocess.run(
             ["docker", "ps", "-a", "-q", "--filter", f"ancestor={image_name}"],
@@ -36,35 +54,86 @@ class Docker(BaseModel):
         # remove old images
         subprocess.run(["docker", "rmi", image_name], capture_output=True)
 
-    def build_image(self, image_name: str, dir: Path):
+    def build_image(
+        self,
+        image_name: str,
+        dir: Path,
+        on_output: Optional[Callable[[str], None]] = None,
+    ):
+        """Build an image from dir; the api backend streams build output to on_output"""
         if self.mock:
             return
+        if self.backend == "api":
+            return self.engine.build_image(image_name, dir, on_output=on_output)
         output = subprocess.run(
             ["docker", "build", "-t", image_name, dir], capture_output=True
         )
         if output.returncode != 0:
             raise ValueError("Docker build failed")
 
-    def run_container(self, image_name: str, port: int) -> str:
+    def image_exists(self, image_name: str) -> bool:
+        if self.mock:
+            return True
+        if self.backend == "api":
+            return self.engine.image_exists(image_name)
+        output = subprocess.run(
+            ["docker", "image", "inspect", image_name], capture_output=True
+        )
+        return output.returncode == 0
+
+    def run_container(
+        self,
+        image_name: str,
+        port: Optional[int] = None,
+        environment: Optional[Dict[str, str]] = None,
+    ) -> str:
+        """Run a container, publishing its port 8080 on port (or an ephemeral port if None)"""
         if self.mock:
             return "mock"
+        if self.backend == "api":
+            return self.engine.run_container(image_name, port, environment)
+        publish = "8080" if port is None else f"{port}:8080"
+        env_args = []
+        for key, value in (environment or {}).items():
+            env_args += ["-e", f"{key}={value}"]
         output = subprocess.run(
-            ["docker", "run", "-d", "-p", f"{port}:8080", image_name],
+            ["docker", "run", "-d", "-p", publish, *env_args, image_name],
             capture_output=True,
         )
         if output.returncode != 0:
             raise ValueError("Docker run failed")
         return output.stdout.decode("utf-8").strip()
 
+    def container_port(self, cid: str) -> int:
+        """Host port that a container's port 8080 is published on"""
+        if self.mock:
+            return 8080
+        if self.backend == "api":
+            return self.engine.container_port(cid)
+        output = subprocess.run(
+            ["docker", "port", cid, "8080/tcp"], capture_output=True
+        )
+        if output.returncode != 0:
+            raise ValueError("Docker port failed")
+        # e.g. "0.0.0.0:49153\n[::]:49153"
+        return int(output.stdout.decode("utf-8").splitlines()[0].rsplit(":", 1)[1])
+
     def remove_container(self, cid: str):
         if self.mock:
             return
+        if self.backend == "api":
+            return self.engine.remove_container(cid)
         subprocess.run(["docker", "rm", "-f", cid], capture_output=True)
 
     def is_running(self, cid: str) -> bool:
         if self.mock:
             return True
-        output = subprocess.run(["docker", "inspect", cid], capture_output=True)
+        if self.backend == "api":
+            return self.engine.is_running(cid)
+        output = subprocess.run(
+            ["docker", "inspect", "--format", "{{.State.Running}}", cid],
+            capture_output=True,
+        )
         if output.returncode != 0:
             return False
-        return True
+        return output.stdout.decode("utf-8").strip() == "true"
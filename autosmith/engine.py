@@ -0,0 +1,214 @@
+import http.client
+import io
+import json
+import select
+import socket
+import tarfile
+import threading
+import urllib.parse
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional
+
+_engines: Dict[str, "DockerEngine"] = {}
+_engines_lock = threading.Lock()
+
+
+# requests that can be sent again if the connection broke before their response
+_IDEMPOTENT = {"GET", "HEAD", "DELETE"}
+
+
+def _is_closed(sock: socket.socket) -> bool:
+    """Whether the peer closed an idle connection (nothing is expected on it)"""
+    readable, _, _ = select.select([sock], [], [], 0)
+    if not readable:
+        return False
+    try:
+        return sock.recv(1, socket.MSG_PEEK) == b""
+    except OSError:
+        return True
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    """HTTP connection over a unix socket"""
+
+    def __init__(self, socket_path: str, timeout: Optional[float] = None):
+        super().__init__("localhost", timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        sock.connect(self.socket_path)
+        self.sock = sock
+
+
+class DockerEngine:
+    """Client for the Docker Engine API over its unix socket
+
+    Each thread keeps one persistent connection, so requests do not pay for
+    process spawns or reconnects.
+    """
+
+    def __init__(self, socket_path: str):
+        self.socket_path = socket_path
+        self._local = threading.local()
+
+    def _connection(self) -> UnixHTTPConnection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = UnixHTTPConnection(self.socket_path)
+            self._local.conn = conn
+        return conn
+
+    def _send(
+        self,
+        method: str,
+        path: str,
+        body: Optional[bytes] = None,
+        headers: Optional[Dict[str, str]] = None,
+    ) -> http.client.HTTPResponse:
+        headers = headers or {}
+        if body is None and method == "POST":
+            body = b""
+        conn = self._connection()
+        if conn.sock is not None and _is_closed(conn.sock):
+            # server closed the idle keep-alive connection - reconnect
+            conn.close()
+        try:
+            conn.request(method, path, body=body, headers=headers)
+            return conn.getresponse()
+        except (http.client.RemoteDisconnected, BrokenPipeError, ConnectionResetError):
+            conn.close()
+            # the request may have been handled, so only repeat it if that is harmless
+            if method not in _IDEMPOTENT:
+                raise
+        conn.request(method, path, body=body, headers=headers)
+        return conn.getresponse()
+
+    def request(
+        self,
+        method: str,
+        path: str,
+        body: Optional[Any] = None,
+        query: Optional[Dict[str, Any]] = None,
+    ):
+        """Send a request and return (status, decoded JSON body or None)"""
+        if query:
+            path = f"{path}?{urllib.parse.urlencode(query)}"
+        data = None
+        headers = {}
+        if body is not None:
+            data = json.dumps(body).encode("utf-8")
+            headers["Content-Type"] = "application/json"
+        response = self._send(method, path, body=data, headers=headers)
+        raw = response.read()
+        if not raw:
+            return response.status, None
+        try:
+            return response.status, json.loads(raw)
+        except json.JSONDecodeError:
+            return response.status, raw.decode("utf-8", errors="replace")
+
+    def containers(self, filters: Dict[str, List[str]]) -> List[Dict[str, Any]]:
+        """List all (including stopped) containers matching filters"""
+        status, body = self.request(
+            "GET", "/containers/json", query={"all": 1, "filters": json.dumps(filters)}
+        )
+        if status != 200:
+            raise ValueError("Docker ps failed")
+        return body
+
+    def remove_container(self, cid: str):
+        self.request("DELETE", f"/containers/{cid}", query={"force": 1})
+
+    def remove_image(self, image_name: str):
+        for container in self.containers({"ancestor": [image_name]}):
+            self.remove_container(container["Id"])
+        self.request("DELETE", f"/images/{image_name}")
+
+    def image_exists(self, image_name: str) -> bool:
+        status, _ = self.request("GET", f"/images/{image_name}/json")
+        return status == 200
+
+    def build_image(
+        self,
+        image_name: str,
+        dir: Path,
+        on_output: Optional[Callable[[str], None]] = None,
+    ):
+        """Build an image from dir, streaming build output to on_output"""
+        context = io.BytesIO()
+        with tarfile.open(fileobj=context, mode="w") as tar:
+            tar.add(str(dir), arcname=".")
+        path = "/build?" + urllib.parse.urlencode({"t": image_name, "rm": 1})
+        response = self._send(
+            "POST",
+            path,
+            body=context.getvalue(),
+            headers={"Content-Type": "application/x-tar"},
+        )
+        if response.status != 200:
+            response.read()
+            raise ValueError("Docker build failed")
+        error = None
+        # output is a stream of JSON messages, one per line
+        for line in response:
+            if not line.strip():
+                continue
+            message = json.loads(line)
+            if "error" in message:
+                error = message["error"]
+            elif "stream" in message and on_output is not None:
+                on_output(message["stream"])
+        if error is not None:
+            raise ValueError(f"Docker build failed: {error}")
+
+    def run_container(
+        self,
+        image_name: str,
+        port: Optional[int] = None,
+        environment: Optional[Dict[str, str]] = None,
+    ) -> str:
+        host_port = "" if port is None else str(port)
+        status, body = self.request(
+            "POST",
+            "/containers/create",
+            body={
+                "Image": image_name,
+                "Env": [f"{k}={v}" for k, v in (environment or {}).items()],
+                "ExposedPorts": {"8080/tcp": {}},
+                "HostConfig": {"PortBindings": {"8080/tcp": [{"HostPort": host_port}]}},
+            },
+        )
+        if status != 201:
+            raise ValueError("Docker run failed")
+        cid = body["Id"]
+        status, _ = self.request("POST", f"/containers/{cid}/start")
+        if status not in (204, 304):
+            raise ValueError("Docker run failed")
+        return cid
+
+    def inspect_container(self, cid: str) -> Optional[Dict[str, Any]]:
+        status, body = self.request("GET", f"/containers/{cid}/json")
+        if status != 200:
+            return None
+        return body
+
+    def is_running(self, cid: str) -> bool:
+        info = self.inspect_container(cid)
+        return info is not None and info["State"]["Running"]
+
+    def container_port(self, cid: str) -> int:
+        info = self.inspect_container(cid)
+        if info is None:
+            raise ValueError("Docker port failed")
+        return int(info["NetworkSettings"]["Ports"]["8080/tcp"][0]["HostPort"])
+
+
+def get_engine(socket_path: Path) -> DockerEngine:
+    """Get the process-wide engine client for a socket"""
+    key = str(socket_path)
+    with _engines_lock:
+        if key not in _engines:
+            _engines[key] = DockerEngine(key)
+        return _engines[key]
@@ -1,15 +1,59 @@
+import hashlib
 import os
 import pickle
+import secrets
 from pathlib import Path
-from typing import Callable, Dict, Optional, Union
+from typing import Any, Callable, Dict, List, Literal, Optional, Tuple, Union
 
-import pkg_resources
+from packaging.requirements import Requirement
 from pydantic import BaseModel, Field, PrivateAttr, validator
 
+from .client import Replica, ToolClient
 from .docker import Docker
+from .ports import PortRegistry
+from .runtime import Runtime
+from .timing import Span
 from .version import __version__
 
 Function = Union[str, Callable]
+# how the generated server runs a tool function
+Executor = Literal["thread", "process", "async"]
+
+# fields of ToolEnv that are rendered into the image or used to start its containers
+_CONTAINER_SETTINGS = {
+    "requirements",
+    "name",
+    "version",
+    "host",
+    "port",
+    "auto_port",
+    "docker_file_commands",
+    "base_image",
+    "workers",
+    "replicas",
+    "metrics",
+    "msgpack",
+    "rpc",
+    "admin_token",
+}
+
+
+class ResultCache(BaseModel):
+    """ResultCache configures caching of a tool's results by the server
+
+    Only for tools whose result depends on nothing but their input. At most size
+    results are kept, each for ttl seconds (forever if None), and identical
+    calls that arrive while one is running wait for its result.
+    """
+
+    size: int = 1024
+    ttl: Optional[float] = None
+
+    @validator("size")
+    def size_must_be_positive(cls, v):
+        if v < 1:
+            raise ValueError("Must be at least 1")
+        return v
 
 
 class EncodedTool(BaseModel):
@@ -20,6 +64,22 @@ class EncodedTool(BaseModel):
     input_class_name: str
     description: str
     input_class_raw_schema: str
+    # how the generated server runs the function: in a thread pool (blocking I/O),
+    # a process pool (CPU-bound) or awaited directly (async def)
+    executor: Executor = "thread"
+    result_cache: Optional[ResultCache] = None
+    # generator whose results the server streams as they are produced
+    stream: bool = False
+    # arguments the server passes to the function as numpy arrays
+    arrays: List[str] = []
+    # (cache key, rendered server code) - see template.render_tool
+    _rendered: Optional[Tuple[str, str]] = PrivateAttr(None)
+
+    def __setattr__(self, name, value):
+        super().__setattr__(name, value)
+        # the rendered code is stale once a field changes
+        if name not in self.__private_attributes__:
+            self._rendered = None
 
     @validator("input_class_name")
     def input_class_name_should_be_capitalized(cls, v):
@@ -29,6 +89,11 @@ class EncodedTool(BaseModel):
     def function_name_cannot_be_docs(cls, v):
         if v == "docs" or v == "Docs":
             raise ValueError("Function name cannot be docs")
+        if v == "healthz":
+            raise ValueError("Function name cannot be healthz")
+        # served by the generated server when ToolEnv.metrics is set
+        if v == "metrics":
+            raise ValueError("Function name cannot be metrics")
         return v
 
 
@@ -37,24 +102,56 @@ class ToolEnv(BaseModel):
 
     requirements: str
     name: str = "tool-environment"
+    # tells environments of the same name apart, e.g. in the port registry
+    uid: str = Field(default_factory=lambda: secrets.token_hex(8))
     version: str = __version__
     host: str = "127.0.0.1"
     port: int = 8080
+    # let docker pick a free host port on every start (also set by port=0)
+    auto_port: bool = False
     tools: Dict[str, EncodedTool] = {}
     docker_file_commands: str = ""
     base_image: str = "python:3.11-slim"
     container_id: Optional[str] = None
+    # uvicorn workers per container and number of containers to run
+    workers: int = 1
+    replicas: int = 1
+    # serve per-tool request metrics on /metrics (see stats)
+    metrics: bool = False
+    # install msgpack in the image, so tools can be called with msgpack bodies
+    msgpack: bool = False
+    # serve a WebSocket at /_rpc that multiplexes tool calls (installs websockets)
+    rpc: bool = False
+    containers: List[Replica] = []
+    image: Optional[str] = None
+    image_requirements: Optional[str] = None
+    # image env.image was built on top of (None if base_image), and the base_image
+    # and docker_file_commands it was built with
+    parent_image: Optional[str] = None
+    image_base: Optional[Tuple[str, str]] = None
+    # settings_hash of the running containers, see smith._hot_reload
+    deployed_settings: Optional[str] = None
+    # phases of the last smith and how long they took
+    timings: List[Span] = []
+    # lets smith add tools to the running containers (None disables it)
+    admin_token: Optional[str] = Field(default_factory=lambda: secrets.token_hex(16))
     _saved: bool = PrivateAttr(False)
+    # (host and replicas, client for them) - see client
+    _client: Optional[Tuple[Tuple, ToolClient]] = PrivateAttr(None)
     save_dir: Optional[Path] = Path.home() / ".autosmith"
-    docker: Docker = Field(default_factory=Docker)
+    docker: Runtime = Field(default_factory=Docker)
     url: str = ""
 
     @validator("requirements")
     def requirements_must_be_valid(cls, v):
-        try:
-            pkg_resources.parse_requirements(v.splitlines())
-        except ValueError:
-            raise ValueError("Requirements must be valid")
+        # imported here since func imports env
+        from .func import requirement_lines
+
+        for line in requirement_lines(v):
+            try:
+                Requirement(line)
+            except ValueError:
+                raise ValueError("Requirements must be valid")
         return v
 
     @validator("url", always=True, pre=True)
@@ -62,10 +159,98 @@ class ToolEnv(BaseModel):
         """url is the url of the tool environment"""
         return f"http://{values['host']}:{values['port']}"
 
+    @validator("auto_port", always=True)
+    def port_zero_is_auto(cls, v, values):
+        return v or values.get("port") == 0
+
+    @validator("workers", "replicas")
+    def must_be_positive(cls, v):
+        if v < 1:
+            raise ValueError("Must be at least 1")
+        return v
+
+    @validator("metrics")
+    def metrics_need_one_worker(cls, v, values):
+        # every uvicorn worker counts its own requests and /metrics reaches one
+        if v and values.get("workers", 1) > 1:
+            raise ValueError("Metrics need workers=1")
+        return v
+
+    def container_ids(self) -> List[str]:
+        """Ids of all containers (replicas) of the tool environment"""
+        cids = [r.container_id for r in self.containers]
+        if self.container_id is not None and self.container_id not in cids:
+            cids.append(self.container_id)
+        return cids
+
+    def settings_hash(self) -> str:
+        """Hash of the settings (besides tools) the image and containers are made from"""
+        settings = self.json(include=_CONTAINER_SETTINGS, sort_keys=True)
+        return hashlib.sha256(settings.encode("utf-8")).hexdigest()
+
+    def port_registry(self) -> Optional[PortRegistry]:
+        """Host-wide registry of ports owned by tool environments, kept in save_dir"""
+        if self.save_dir is None:
+            return None
+        return PortRegistry(path=self.save_dir / "ports.json")
+
+    def port_owner(self) -> str:
+        """Owner of env's ports in the port registry"""
+        return f"{self.name}/{self.uid}"
+
+    def assign_port(self, port: int):
+        """Set the host port of the (first) replica"""
+        self.port = port
+        self.url = f"http://{self.host}:{port}"
+
+    def release_ports(self):
+        """Release the ports of all replicas in the port registry"""
+        registry = self.port_registry()
+        if registry is None:
+            return
+        for replica in self.containers:
+            registry.release(replica.port, owner=self.port_owner())
+
     def close(self):
-        cid = self.container_id
-        if cid is not None and not self._saved:
+        if self._saved:
+            return
+        for cid in self.container_ids():
             self.docker.remove_container(cid)
+        self.release_ports()
+
+    def client(self) -> ToolClient:
+        """Client that spreads calls across the running replicas
+
+        The same client (and its round-robin position and dropped replicas) is
+        returned until the replicas change.
+        """
+        replicas = self.containers
+        if not replicas and self.container_id is not None:
+            replicas = [Replica(container_id=self.container_id, port=self.port)]
+        if not replicas:
+            raise ValueError("Tool environment is not running")
+        key = (self.host, tuple((r.container_id, r.port) for r in replicas))
+        if self._client is None or self._client[0] != key:
+            self._client = (key, ToolClient(self.host, replicas, self.docker))
+        return self._client[1]
+
+    def batch(self, endpoint: str, inputs: List[Dict[str, Any]]) -> List[Any]:
+        """Call a tool on many inputs in one request, returning results in order"""
+        return self.client().batch(endpoint, inputs)
+
+    def cache_stats(self) -> Dict[str, Dict[str, int]]:
+        """Result cache hits, misses, coalesced calls and size per cached tool"""
+        if self.workers > 1:
+            raise ValueError("Each worker has its own caches, so stats need workers=1")
+        return self.client().cache_stats()
+
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        """Request metrics per tool, summed over replicas (needs metrics=True)"""
+        if not self.metrics:
+            raise ValueError("Tool environment does not serve metrics")
+        if self.workers > 1:
+            raise ValueError("Each worker has its own metrics, so stats need workers=1")
+        return self.client().stats()
 
     def __enter__(self):
         return self
@@ -73,6 +258,15 @@ class ToolEnv(BaseModel):
     def __exit__(self, exc_type, exc_value, traceback):
         self.close()
 
+    def __getstate__(self):
+        state = super().__getstate__()
+        # the client holds a lock and is rebuilt on demand
+        state["__private_attribute_values__"] = {
+            **state["__private_attribute_values__"],
+            "_client": None,
+        }
+        return state
+
     def save(self):
         """Save the tool environment"""
         if self.save_dir is None:
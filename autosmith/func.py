@@ -1,32 +1,53 @@
 import ast
+import hashlib
 import inspect
+import json
+import os
+import re
 import sys
 import textwrap
-from typing import Callable, Dict, List, Mapping, Set, Tuple, cast
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Mapping, Optional, Set, Tuple, cast
 
-import importlib_metadata
 from packaging.requirements import Requirement
 
+from .cache import get_cache_dir
 from .env import Function
 
+# import name -> distributions and distribution -> version, for one site fingerprint
+_distributions: Dict[str, Any] = {}
+_distributions_lock = threading.Lock()
+
+# (module name, source hash) -> (imports, wildcards), least recently used first
+MODULE_CACHE_SIZE = 128
+_module_imports: "OrderedDict[Tuple[str, str], Tuple[Dict[str, str], Set[str]]]" = (
+    OrderedDict()
+)
+_module_imports_lock = threading.Lock()
+
+
+def requirement_lines(requirements: str) -> List[str]:
+    """Lines of a requirements.txt without comments and blank lines, as pip reads them"""
+    lines = []
+    for line in requirements.splitlines():
+        line = re.sub(r"(^|\s)#.*$", "", line).strip()
+        if line:
+            lines.append(line)
+    return lines
+
 
 def _parse_requirements(requirements: str) -> Set[Requirement]:
     """Parse a requirements.txt file into a set of Requirement objects"""
-    return set(
-        [
-            Requirement(line.strip())
-            for line in requirements.splitlines()
-            if len(line.strip()) > 0
-        ]
-    )
+    return set([Requirement(line) for line in requirement_lines(requirements)])
 
 
-def get_imports(source: str) -> Tuple[Dict[str, str], Set[str]]:
-    module_node: ast.AST = ast.parse(source)
+def _get_node_imports(node: ast.AST) -> Tuple[Dict[str, str], Set[str]]:
     imports: Dict[str, str] = dict()
     wildcards = set()
     # Walk through all the nodes in the module body
-    for n in ast.walk(module_node):
+    for n in ast.walk(node):
         if isinstance(n, ast.Import):
             imports.update({a.name: a.name for a in n.names if not a.asname})
             imports.update({a.asname: a.name for a in n.names if a.asname})
@@ -41,6 +62,29 @@ def get_imports(source: str) -> Tuple[Dict[str, str], Set[str]]:
     return imports, wildcards
 
 
+def get_imports(source: str) -> Tuple[Dict[str, str], Set[str]]:
+    return _get_node_imports(ast.parse(source))
+
+
+def get_module_imports(module_name: str) -> Tuple[Dict[str, str], Set[str]]:
+    """Get the imports of a loaded module, cached by module name and source hash
+
+    Only the last MODULE_CACHE_SIZE modules are kept.
+    """
+    module_source: str = inspect.getsource(sys.modules[module_name])
+    key = (module_name, hashlib.sha256(module_source.encode("utf-8")).hexdigest())
+    with _module_imports_lock:
+        if key in _module_imports:
+            _module_imports.move_to_end(key)
+            return _module_imports[key]
+    result = get_imports(module_source)
+    with _module_imports_lock:
+        _module_imports[key] = result
+        while len(_module_imports) > MODULE_CACHE_SIZE:
+            _module_imports.popitem(last=False)
+    return result
+
+
 def get_func_imports(func: Function) -> List[str]:
     """Get the imports necessary to run a function - either present in module or body"""
     module_imports: Dict[str, str] = dict()
@@ -54,31 +98,116 @@ def get_func_imports(func: Function) -> List[str]:
 
         module_name: str = func.__module__
         if module_name != "__main__":
-            module_source: str = inspect.getsource(sys.modules[module_name])
-            module_imports, module_wildcards = get_imports(module_source)
+            module_imports, module_wildcards = get_module_imports(module_name)
 
-    func_imports, func_wildcards = get_imports(source)
-    all_imports = set(func_imports.values()) | module_wildcards | func_wildcards
     source_node: ast.AST = ast.parse(source)
+    func_imports, func_wildcards = _get_node_imports(source_node)
+    all_imports = set(func_imports.values()) | module_wildcards | func_wildcards
     # now see which module imports are actually used in the function
     for n in ast.walk(source_node):
         if isinstance(n, ast.Name):
             if n.id in module_imports:
                 all_imports.add(module_imports[n.id])
-    return list(all_imports)
+    return sorted(all_imports)
+
+
+def _normalize_name(name: str) -> str:
+    return re.sub(r"[-_.]+", "-", name).lower()
+
+
+def _site_fingerprint() -> str:
+    """Fingerprint of sys.path and the modification times of its entries
+
+    Installing or removing a distribution changes the mtime of its site-packages directory.
+    """
+    h = hashlib.sha256()
+    for entry in sys.path:
+        try:
+            mtime = os.stat(entry or ".").st_mtime_ns
+        except OSError:
+            mtime = 0
+        h.update(f"{entry}\0{mtime}\n".encode("utf-8"))
+    return h.hexdigest()
+
+
+def _distributions_path() -> Optional[Path]:
+    cache_dir = get_cache_dir()
+    if cache_dir is None:
+        return None
+    prefix = hashlib.sha256(sys.prefix.encode("utf-8")).hexdigest()[:16]
+    return cache_dir / f"distributions-{prefix}.json"
+
+
+def _scan_distributions() -> Dict[str, Any]:
+    import importlib_metadata
+
+    packages = {
+        k: list(v) for k, v in importlib_metadata.packages_distributions().items()
+    }
+    versions: Dict[str, str] = {}
+    for dist in importlib_metadata.distributions():
+        name = dist.metadata["Name"]
+        # first on sys.path wins, as in importlib_metadata.version
+        if name and _normalize_name(name) not in versions:
+            versions[_normalize_name(name)] = dist.version
+    return {"packages": packages, "versions": versions}
+
+
+def get_distributions() -> Tuple[Mapping[str, List[str]], Mapping[str, str]]:
+    """Get the import name to distributions and distribution to version mappings
+
+    Scanning installed distributions is slow, so the result is cached for the process
+    (and on disk per interpreter prefix if a cache dir is set) until sys.path or the
+    contents of its directories change.
+    """
+    global _distributions
+    fingerprint = _site_fingerprint()
+    with _distributions_lock:
+        if _distributions.get("fingerprint") != fingerprint:
+            path = _distributions_path()
+            loaded: Dict[str, Any] = {}
+            if path is not None and path.exists():
+                try:
+                    with open(path, "r") as f:
+                        loaded = json.load(f)
+                except (OSError, json.JSONDecodeError):
+                    loaded = {}
+            if loaded.get("fingerprint") == fingerprint:
+                _distributions = loaded
+            else:
+                _distributions = {"fingerprint": fingerprint, **_scan_distributions()}
+                if path is not None:
+                    path.parent.mkdir(parents=True, exist_ok=True)
+                    tmp = path.with_suffix(f".{os.getpid()}.tmp")
+                    with open(tmp, "w") as f:
+                        json.dump(_distributions, f)
+                    os.replace(tmp, path)
+        return _distributions["packages"], _distributions["versions"]
+
+
+def clear_distribution_cache():
+    """Forget the cached distribution mappings (not the on-disk copy)"""
+    global _distributions
+    with _distributions_lock:
+        _distributions = {}
 
 
 def get_requirements_from_imports(imports: List[str]) -> str:
     """Get the PyPI package name and versions for a list of imports as requirements.txt"""
-    packages: Mapping[str, List[str]] = importlib_metadata.packages_distributions()
+    import importlib_metadata
+
+    packages, versions = get_distributions()
     pypi_names: List[str] = []
     for module in imports:
         if module in packages:
             # Use the first element of the list as the distribution name
             dist: str = packages[module][0]
-            version: str = importlib_metadata.version(dist)
+            version: str = versions.get(
+                _normalize_name(dist)
+            ) or importlib_metadata.version(dist)
             specifier: str = f"{dist}=={version}"
-            pypi_names.append(specifier)
+            if specifier not in pypi_names:
+                pypi_names.append(specifier)
     return "\n".join(pypi_names)
 
 
@@ -101,7 +230,8 @@ def merge_requirements(env_requirements: str, func_requirements: str) -> str:
     func_reqs = _parse_requirements(func_requirements)
 
     merged_reqs = env_reqs.union(func_reqs)
-    return "\n".join([str(r) for r in merged_reqs])
+    # sorted so the rendered requirements.txt (and its image hash) is stable
+    return "\n".join(sorted([str(r) for r in merged_reqs]))
 
 
 def get_requirements(func: Function) -> str:
@@ -0,0 +1,253 @@
+import contextlib
+import fcntl
+import hashlib
+import json
+import os
+import re
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import time
+from pathlib import Path
+from typing import Callable, Dict, Iterator, List, Optional
+
+from .runtime import Runtime
+
+# container id -> process and port, for processes started by this interpreter
+_processes: Dict[str, subprocess.Popen] = {}
+_ports: Dict[str, int] = {}
+
+
+@contextlib.contextmanager
+def _file_lock(path: Path) -> Iterator[None]:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def _process_start(pid: int) -> Optional[str]:
+    """When process pid started (None if it is not running), to tell reused pids apart"""
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            # state and starttime are the 3rd and 22nd field, after the parenthesized name
+            fields = f.read().rsplit(")", 1)[1].split()
+        return None if fields[0] == "Z" else fields[19]
+    except FileNotFoundError:
+        if Path("/proc/self/stat").exists():
+            return None
+    except (IndexError, OSError):
+        return None
+    # no procfs, e.g. on macOS
+    output = subprocess.run(
+        ["ps", "-o", "lstart=", "-p", str(pid)], capture_output=True
+    )
+    start = output.stdout.decode("utf-8").strip()
+    return start if output.returncode == 0 and start else None
+
+
+def _image_command(dockerfile: str) -> List[str]:
+    """The CMD of a rendered Dockerfile as a list of arguments"""
+    # join continuation lines so every instruction is on one line
+    instructions = re.sub(r"\\\s*\n\s*", " ", dockerfile).splitlines()
+    for line in reversed(instructions):
+        if line.startswith("CMD "):
+            return json.loads(line[len("CMD ") :])
+    raise ValueError("Dockerfile has no CMD")
+
+
+class LocalRuntime(Runtime):
+    """LocalRuntime serves tool environments as local uvicorn processes, without containers
+
+    An image is a directory under root with the rendered main.py and the command
+    of the Dockerfile. By default the server runs with this interpreter, which then
+    must have the requirements (and fastapi and uvicorn) installed. With venv, a
+    virtual environment is created for each distinct requirements.txt and reused.
+    docker_file_commands and base_image of the environment are ignored.
+    """
+
+    root: Path = Path.home() / ".autosmith" / "local"
+    python: Path = Path(sys.executable)
+    venv: bool = False
+    host: str = "127.0.0.1"
+
+    def _image_dir(self, image_name: str) -> Path:
+        return self.root / "images" / image_name.replace(":", "-").replace("/", "-")
+
+    def _pid_file(self, cid: str) -> Path:
+        return self.root / "pids" / f"{cid}.json"
+
+    def _is_ours(self, cid: str) -> bool:
+        """Whether process cid is still the server started as cid, not a reused pid"""
+        try:
+            record = json.loads(self._pid_file(cid).read_text())
+            start = _process_start(int(cid))
+        except (FileNotFoundError, json.JSONDecodeError, ValueError):
+            return False
+        return start is not None and start == record["start"]
+
+    def _venv_python(
+        self,
+        requirements: str,
+        on_output: Optional[Callable[[str], None]] = None,
+    ) -> Path:
+        """Python of a venv with requirements installed, created on first use"""
+        key = hashlib.sha256(
+            f"{self.python}\0{requirements}".encode("utf-8")
+        ).hexdigest()[:16]
+        venv = self.root / "venvs" / key
+        python = venv / "bin" / "python"
+        with _file_lock(venv.with_suffix(".lock")):
+            if (venv / ".complete").exists():
+                return python
+            shutil.rmtree(venv, ignore_errors=True)
+            commands = [
+                [str(self.python), "-m", "venv", str(venv)],
+                [str(python), "-m", "pip", "install", "-r", "/dev/stdin"],
+            ]
+            for command in commands:
+                output = subprocess.run(
+                    command,
+                    input=requirements.encode("utf-8"),
+                    capture_output=True,
+                )
+                if on_output is not None:
+                    for line in output.stdout.decode("utf-8").splitlines():
+                        on_output(line)
+                if output.returncode != 0:
+                    raise ValueError(
+                        "Creating venv failed: " + output.stderr.decode("utf-8")
+                    )
+            (venv / ".complete").touch()
+        return python
+
+    def remove_image(self, image_name: str):
+        if self.mock:
+            return
+        shutil.rmtree(self._image_dir(image_name), ignore_errors=True)
+
+    def build_image(
+        self,
+        image_name: str,
+        dir: Path,
+        on_output: Optional[Callable[[str], None]] = None,
+    ):
+        """Copy main.py to the image directory and resolve the python to serve it with"""
+        if self.mock:
+            return
+        requirements = (dir / "requirements.txt").read_text()
+        python = (
+            self._venv_python(requirements, on_output) if self.venv else self.python
+        )
+        command = _image_command((dir / "Dockerfile").read_text())
+        image_dir = self._image_dir(image_name)
+        tmp = image_dir.with_name(f"{image_dir.name}.{os.getpid()}.tmp")
+        shutil.rmtree(tmp, ignore_errors=True)
+        tmp.mkdir(parents=True)
+        shutil.copy(dir / "main.py", tmp / "main.py")
+        shutil.copy(dir / "requirements.txt", tmp / "requirements.txt")
+        (tmp / "image.json").write_text(
+            json.dumps({"python": str(python), "command": command})
+        )
+        shutil.rmtree(image_dir, ignore_errors=True)
+        os.replace(tmp, image_dir)
+
+    def image_exists(self, image_name: str) -> bool:
+        if self.mock:
+            return True
+        return (self._image_dir(image_name) / "image.json").exists()
+
+    def run_container(
+        self,
+        image_name: str,
+        port: Optional[int] = None,
+        environment: Optional[Dict[str, str]] = None,
+    ) -> str:
+        """Start the image's server command (uvicorn) as a process in its own session"""
+        if self.mock:
+            return "mock"
+        image_dir = self._image_dir(image_name)
+        try:
+            image = json.loads((image_dir / "image.json").read_text())
+        except FileNotFoundError:
+            raise ValueError(f"Image {image_name} does not exist")
+        if port is None:
+            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+                sock.bind((self.host, 0))
+                port = sock.getsockname()[1]
+        command = list(image["command"])
+        for flag, value in (("--port", str(port)), ("--host", self.host)):
+            if flag in command:
+                command[command.index(flag) + 1] = value
+        (self.root / "logs").mkdir(parents=True, exist_ok=True)
+        log_path = self.root / "logs" / f"{image_dir.name}-{port}.log"
+        with open(log_path, "wb") as log:
+            process = subprocess.Popen(
+                [image["python"], "-m", *command],
+                cwd=image_dir,
+                env={**os.environ, **(environment or {})},
+                stdout=log,
+                stderr=subprocess.STDOUT,
+                start_new_session=True,
+            )
+        cid = str(process.pid)
+        _processes[cid] = process
+        _ports[cid] = port
+        # lets other interpreters check that the pid still is this server
+        self._pid_file(cid).parent.mkdir(parents=True, exist_ok=True)
+        self._pid_file(cid).write_text(
+            json.dumps({"start": _process_start(process.pid), "port": port})
+        )
+        return cid
+
+    def container_port(self, cid: str) -> int:
+        if self.mock:
+            return 8080
+        if cid in _ports:
+            return _ports[cid]
+        if not self._is_ours(cid):
+            raise ValueError("Port of process is unknown")
+        return json.loads(self._pid_file(cid).read_text())["port"]
+
+    def remove_container(self, cid: str):
+        """Stop the server process and its workers"""
+        if self.mock:
+            return
+        process = _processes.pop(cid, None)
+        _ports.pop(cid, None)
+        # a pid not started by this interpreter may since belong to another process
+        ours = process is not None or self._is_ours(cid)
+        self._pid_file(cid).unlink(missing_ok=True)
+        if not ours:
+            return
+        try:
+            os.killpg(int(cid), signal.SIGTERM)
+        except (ProcessLookupError, PermissionError, ValueError):
+            return
+        if process is not None:
+            try:
+                process.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                os.killpg(int(cid), signal.SIGKILL)
+                process.wait()
+            return
+        # not started by this interpreter, so it cannot be waited for
+        start = _process_start(int(cid))
+        deadline = time.monotonic() + 5
+        while _process_start(int(cid)) == start and time.monotonic() < deadline:
+            time.sleep(0.05)
+        if start is not None and _process_start(int(cid)) == start:
+            os.killpg(int(cid), signal.SIGKILL)
+
+    def is_running(self, cid: str) -> bool:
+        if self.mock:
+            return True
+        process = _processes.get(cid)
+        if process is not None:
+            return process.poll() is None
+        return self._is_ours(cid)
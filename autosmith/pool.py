@@ -0,0 +1,147 @@
+import secrets
+import threading
+import time
+from typing import Dict, List, Optional, Set
+
+from pydantic import BaseModel, Field, PrivateAttr, validator
+
+from .client import Replica
+from .docker import Docker
+from .ready import Readiness
+from .runtime import Runtime
+
+
+class WarmPool(BaseModel):
+    """Pre-started containers per image, handed out by smith instead of a cold start
+
+    Up to size ready containers are kept running for every image that was asked
+    for, on ports assigned by docker. Images are content-addressed, so a warm
+    container always serves exactly the requested tools and requirements. Taking
+    a container refills the pool in the background, and the containers of images
+    nobody asked for in idle_timeout seconds are removed. Warm containers accept
+    admin_token, which smith gives the environments it serves from the pool so
+    that tools can be added to them (None disables it).
+    """
+
+    size: int = 2
+    idle_timeout: float = 600.0
+    host: str = "127.0.0.1"
+    docker: Runtime = Field(default_factory=Docker)
+    ready: Readiness = Field(default_factory=Readiness)
+    admin_token: Optional[str] = Field(default_factory=lambda: secrets.token_hex(16))
+    _warm: Dict[str, List[Replica]] = PrivateAttr(default_factory=dict)
+    _last_used: Dict[str, float] = PrivateAttr(default_factory=dict)
+    _filling: Set[str] = PrivateAttr(default_factory=set)
+    _lock: threading.Lock = PrivateAttr(default_factory=threading.Lock)
+    _closed: threading.Event = PrivateAttr(default_factory=threading.Event)
+    _reaper: Optional[threading.Thread] = PrivateAttr(None)
+
+    @validator("size")
+    def size_must_be_positive(cls, v):
+        if v < 1:
+            raise ValueError("Must be at least 1")
+        return v
+
+    def warm(self, image: str) -> int:
+        """Number of warm containers of image"""
+        with self._lock:
+            return len(self._warm.get(image, []))
+
+    def take(self, image: str) -> Optional[Replica]:
+        """Hand out a warm container of image, or None if there is none yet
+
+        Either way the pool of image is refilled in the background.
+        """
+        replica = None
+        with self._lock:
+            self._last_used[image] = time.monotonic()
+        while replica is None:
+            with self._lock:
+                warm = self._warm.get(image)
+                if not warm:
+                    break
+                candidate = warm.pop(0)
+            if self.docker.is_running(candidate.container_id):
+                replica = candidate
+            else:
+                self.docker.remove_container(candidate.container_id)
+        self.refill(image)
+        return replica
+
+    def refill(self, image: str):
+        """Start containers of image in the background until size are warm"""
+        with self._lock:
+            if self._closed.is_set() or image in self._filling:
+                return
+            self._filling.add(image)
+            self._last_used.setdefault(image, time.monotonic())
+            if self._reaper is None:
+                self._reaper = threading.Thread(target=self._reap, daemon=True)
+                self._reaper.start()
+        threading.Thread(target=self.fill, args=(image,), daemon=True).start()
+
+    def fill(self, image: str):
+        """Start containers of image until size are warm, blocking until they are ready"""
+        with self._lock:
+            self._last_used.setdefault(image, time.monotonic())
+        try:
+            while not self._closed.is_set():
+                with self._lock:
+                    if len(self._warm.get(image, [])) >= self.size:
+                        return
+                environment = {}
+                if self.admin_token is not None:
+                    environment["AUTOSMITH_ADMIN_TOKEN"] = self.admin_token
+                cid = self.docker.run_container(image, None, environment)
+                try:
+                    port = self.docker.container_port(cid)
+                    self.ready.wait(f"http://{self.host}:{port}", self.docker, cid)
+                except Exception:
+                    # leave the error to the next cold start of the image
+                    self.docker.remove_container(cid)
+                    return
+                with self._lock:
+                    keep = not self._closed.is_set() and image in self._last_used
+                    if keep:
+                        self._warm.setdefault(image, []).append(
+                            Replica(container_id=cid, port=port)
+                        )
+                if not keep:
+                    self.docker.remove_container(cid)
+                    return
+        finally:
+            with self._lock:
+                self._filling.discard(image)
+
+    def evict_idle(self) -> int:
+        """Remove warm containers of images unused for idle_timeout, returning how many"""
+        now = time.monotonic()
+        evicted: List[Replica] = []
+        with self._lock:
+            for image, last_used in list(self._last_used.items()):
+                if now - last_used > self.idle_timeout:
+                    del self._last_used[image]
+                    evicted.extend(self._warm.pop(image, []))
+        for replica in evicted:
+            self.docker.remove_container(replica.container_id)
+        return len(evicted)
+
+    def _reap(self):
+        while not self._closed.wait(self.idle_timeout / 2):
+            self.evict_idle()
+
+    def close(self):
+        """Remove all warm containers and stop refilling"""
+        self._closed.set()
+        with self._lock:
+            warm = [r for replicas in self._warm.values() for r in replicas]
+            self._warm.clear()
+            self._last_used.clear()
+        for replica in warm:
+            self.docker.remove_container(replica.container_id)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -0,0 +1,80 @@
+import contextlib
+import fcntl
+import json
+import os
+import socket
+from pathlib import Path
+from typing import Dict, Iterator, Optional
+
+from pydantic import BaseModel
+
+
+def port_is_free(port: int, host: str = "127.0.0.1") -> bool:
+    """Check whether nothing is bound to port on host"""
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        try:
+            sock.bind((host, port))
+        except OSError:
+            return False
+    return True
+
+
+class PortRegistry(BaseModel):
+    """Host-wide record of which tool environment owns which host port
+
+    The registry is a json file shared by all processes on the host; every
+    read-modify-write holds an exclusive lock on a sibling lock file.
+    """
+
+    path: Path = Path.home() / ".autosmith" / "ports.json"
+
+    @contextlib.contextmanager
+    def _locked(self) -> Iterator[Dict[str, str]]:
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.path.with_suffix(".lock"), "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                owners: Dict[str, str] = {}
+                if self.path.exists():
+                    try:
+                        with open(self.path, "r") as f:
+                            owners = json.load(f)
+                    except json.JSONDecodeError:
+                        owners = {}
+                before = dict(owners)
+                yield owners
+                if owners != before:
+                    tmp = self.path.with_suffix(f".{os.getpid()}.tmp")
+                    with open(tmp, "w") as f:
+                        json.dump(owners, f, indent=2, sort_keys=True)
+                    os.replace(tmp, self.path)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def owners(self) -> Dict[int, str]:
+        """Map of registered ports to the name of the environment owning them"""
+        with self._locked() as owners:
+            return {int(port): owner for port, owner in owners.items()}
+
+    def owner(self, port: int) -> Optional[str]:
+        return self.owners().get(port)
+
+    def register(self, port: int, owner: str):
+        """Record that owner uses port"""
+        with self._locked() as owners:
+            owners[str(port)] = owner
+
+    def release(self, port: int, owner: Optional[str] = None):
+        """Forget port, only if it belongs to owner when given"""
+        with self._locked() as owners:
+            if owner is None or owners.get(str(port)) == owner:
+                owners.pop(str(port), None)
+
+    def prune(self, host: str = "127.0.0.1") -> Dict[int, str]:
+        """Forget registered ports nothing is listening on anymore, returning them"""
+        removed = {}
+        with self._locked() as owners:
+            for port in list(owners):
+                if port_is_free(int(port), host):
+                    removed[int(port)] = owners.pop(port)
+        return removed
@@ -0,0 +1,46 @@
+import time
+import urllib.error
+import urllib.request
+
+from pydantic import BaseModel
+
+from .runtime import Runtime
+
+
+class Readiness(BaseModel):
+    """Readiness is how long and how often to wait for a tool server to come up
+
+    The server's /healthz endpoint is polled with exponential backoff, starting at
+    initial_interval and capped at max_interval, until it answers or deadline
+    seconds have passed. The container is checked between polls so a server that
+    crashed on startup fails immediately instead of at the deadline.
+    """
+
+    deadline: float = 60.0
+    initial_interval: float = 0.01
+    max_interval: float = 0.5
+    backoff: float = 2.0
+    path: str = "/healthz"
+
+    def wait(self, url: str, docker: Runtime, cid: str):
+        """Block until the server at url is ready"""
+        if docker.mock:
+            return
+        start = time.monotonic()
+        interval = self.initial_interval
+        while True:
+            remaining = self.deadline - (time.monotonic() - start)
+            try:
+                with urllib.request.urlopen(
+                    f"{url}{self.path}", timeout=max(min(remaining, 1.0), 0.01)
+                ):
+                    return
+            except (urllib.error.URLError, ConnectionError, OSError):
+                pass
+            if not docker.is_running(cid):
+                raise ValueError("Container exited before server was ready")
+            remaining = self.deadline - (time.monotonic() - start)
+            if remaining <= 0:
+                raise ValueError("Could not connect to server")
+            time.sleep(min(interval, remaining))
+            interval = min(interval * self.backoff, self.max_interval)
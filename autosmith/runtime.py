@@ -0,0 +1,57 @@
+from abc import abstractmethod
+from pathlib import Path
+from typing import Callable, Dict, Optional
+
+from pydantic import BaseModel
+
+
+class Runtime(BaseModel):
+    """Runtime builds and runs the images of tool environments
+
+    Docker is the default; LocalRuntime serves images as local processes. A
+    container serves the tool server on its port 8080, published on a host port.
+    With mock, nothing is built or run.
+    """
+
+    mock: Optional[bool] = False
+
+    @abstractmethod
+    def remove_image(self, image_name: str):
+        raise NotImplementedError
+
+    @abstractmethod
+    def build_image(
+        self,
+        image_name: str,
+        dir: Path,
+        on_output: Optional[Callable[[str], None]] = None,
+    ):
+        """Build an image from the Dockerfile, requirements.txt and main.py in dir"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def image_exists(self, image_name: str) -> bool:
+        raise NotImplementedError
+
+    @abstractmethod
+    def run_container(
+        self,
+        image_name: str,
+        port: Optional[int] = None,
+        environment: Optional[Dict[str, str]] = None,
+    ) -> str:
+        """Run a container on port (or a free port if None), returning its id"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def container_port(self, cid: str) -> int:
+        """Host port a container serves on"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def remove_container(self, cid: str):
+        raise NotImplementedError
+
+    @abstractmethod
+    def is_running(self, cid: str) -> bool:
+        raise NotImplementedError
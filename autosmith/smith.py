@@ -1,51 +1,531 @@
+import asyncio
+import functools
 import os
 import tempfile
-import time
-import urllib.request
+import threading
+import urllib.error
+import warnings
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import Optional
+from typing import Dict, List, Optional, Sequence, Tuple, Union, cast
 
+from .cache import ImageCache, artifact_hash
+from .client import Replica
 from .docker import Docker
-from .env import Function, ToolEnv
-from .func import get_requirements
-from .template import render_container, render_requirements, render_server
+from .env import EncodedTool, Executor, Function, ResultCache, ToolEnv
+from .func import consistent_requirements, get_requirements, merge_requirements
+from .pool import WarmPool
+from .ports import port_is_free
+from .ready import Readiness
+from .runtime import Runtime
+from .template import (
+    encode_tool,
+    func_to_url,
+    get_func_name,
+    render_container,
+    render_main,
+    render_requirements,
+    render_tool,
+    requirement_names,
+)
+from .timing import Timer
 
 
 def smith(
-    func: Function, env: Optional[ToolEnv] = None, docker: Optional[Docker] = None
+    func: Function,
+    env: Optional[ToolEnv] = None,
+    docker: Optional[Runtime] = None,
+    cache: Optional[ImageCache] = None,
+    incremental: bool = True,
+    executor: Optional[Executor] = None,
+    ready: Optional[Readiness] = None,
+    warm_pool: Optional[WarmPool] = None,
+    hot_reload: bool = True,
+    result_cache: Optional[ResultCache] = None,
+    timer: Optional[Timer] = None,
 ) -> ToolEnv:
-    """Adds func to given env (or creates new one)"""
+    """Adds func to given env (or creates new one)
+
+    Images are tagged by a hash of the rendered artifacts, so an environment
+    that renders identically to a previous one is started without a rebuild.
+    The index of built images is kept in ``cache`` (defaults to ``env.save_dir``).
+
+    If ``incremental`` and func only adds requirements to env, the new image is
+    built on top of the previous one rather than from ``env.base_image``; with
+    unchanged requirements it is built on the same image as the previous one.
+    Either needs ``base_image`` and ``docker_file_commands`` to be unchanged.
+
+    ``executor`` chooses how the server runs func ("thread", "process" or "async"),
+    by default "async" for coroutine functions and "thread" otherwise. With
+    ``result_cache`` the server caches func's results by input.
+
+    smith returns as soon as every replica answers on /healthz; ``ready`` sets
+    the deadline and polling backoff.
+
+    Replicas on docker-assigned ports (``port=0`` or beyond the first) are taken
+    from ``warm_pool`` when it has a ready container of the image. A new env is
+    created with ``port=0`` when ``warm_pool`` is given.
+
+    If ``hot_reload`` and env is running with everything func requires, func is
+    added to the running containers instead (see ``_hot_reload``).
+
+    The time spent in each phase is kept in ``env.timings``; pass a ``timer`` to
+    be called back with each phase or to profile them.
+    """
     if docker is None:
-        docker = Docker()
+        docker = Docker() if env is None else env.docker
+    if timer is None:
+        timer = Timer()
+    first = len(timer.spans)
+    with timer.span("requirements", python=True):
+        func_requirements = get_requirements(func)
+    with timer.span("schema", python=True):
+        tool = encode_tool(func, executor=executor, result_cache=result_cache)
     if env is None:
-        env = ToolEnv(requirements=get_requirements(func), docker=docker)
-    if env.container_id is not None:
-        docker.remove_container(env.container_id)
+        # the first replica can only come from the pool on a docker-assigned port
+        env = ToolEnv(
+            requirements=func_requirements,
+            port=0 if warm_pool is not None else 8080,
+            docker=docker,
+        )
+    else:
+        if hot_reload:
+            with timer.span("hot_reload"):
+                reloaded = _hot_reload(env, tool, func_requirements, docker)
+            if reloaded:
+                env.timings = timer.spans[first:]
+                return env
+        if not consistent_requirements(env.requirements, func_requirements):
+            env.requirements = merge_requirements(env.requirements, func_requirements)
+    env.tools[func_to_url(tool.function_name)] = tool
+
+    with timer.span("render", python=True):
+        server = render_main(env)
+    _deploy(env, server, docker, cache, incremental, ready, warm_pool, timer)
+    env.timings = timer.spans[first:]
+    return env
 
-    # TODO: this logic should probably be in env
 
-    docker.remove_image(env.name)
-    # create directory for temp files
-    with tempfile.TemporaryDirectory() as tmpdirname:
-        with open(os.path.join(tmpdirname, "Dockerfile"), "w") as f:
-            f.write(render_container(env))
-        with open(os.path.join(tmpdirname, "main.py"), "w") as f:
-            f.write(render_server(func, tool_env=env))
-        with open(os.path.join(tmpdirname, "requirements.txt"), "w") as f:
-            f.write(render_requirements(env))
-        docker.build_image(env.name, Path(tmpdirname))
-        env.container_id = docker.run_container(env.name, env.port)
-
-    success = bool(docker.mock)
-    for _ in range(10):
-        if success:
-            break
+def smith_many(
+    funcs: Sequence[Function],
+    env: Optional[ToolEnv] = None,
+    docker: Optional[Runtime] = None,
+    cache: Optional[ImageCache] = None,
+    incremental: bool = True,
+    ready: Optional[Readiness] = None,
+    warm_pool: Optional[WarmPool] = None,
+    result_cache: Optional[ResultCache] = None,
+    timer: Optional[Timer] = None,
+) -> Tuple[ToolEnv, Dict[str, Exception]]:
+    """Adds all funcs to given env (or creates new one) with one build and one start
+
+    Functions whose requirements or schema cannot be resolved are left out; their
+    errors are returned by function name instead of aborting the batch.
+    ``result_cache`` applies to every function.
+    """
+    if docker is None:
+        docker = Docker() if env is None else env.docker
+    if timer is None:
+        timer = Timer()
+    first = len(timer.spans)
+    errors: Dict[str, Exception] = {}
+    requirements = "" if env is None else env.requirements
+    resolved = []
+    for i, func in enumerate(funcs):
         try:
-            urllib.request.urlopen(f"{env.url}/docs")
-            success = True
-        except Exception:
-            time.sleep(0.5)
-    if not success:
-        raise ValueError("Could not connect to server")
+            with timer.span("requirements", python=True):
+                func_requirements = get_requirements(func)
+            with timer.span("schema", python=True):
+                tool = encode_tool(func, result_cache=result_cache)
+        except Exception as e:
+            errors[_func_label(func, i)] = e
+            continue
+        if not consistent_requirements(requirements, func_requirements):
+            requirements = merge_requirements(requirements, func_requirements)
+        resolved.append(tool)
+    if not resolved:
+        raise ValueError(f"No functions could be added: {errors}")
+
+    if env is None:
+        env = ToolEnv(
+            requirements=requirements,
+            port=0 if warm_pool is not None else 8080,
+            docker=docker,
+        )
+    else:
+        env.requirements = requirements
+    for tool in resolved:
+        env.tools[func_to_url(tool.function_name)] = tool
+
+    with timer.span("render", python=True):
+        server = render_main(env)
+    _deploy(env, server, docker, cache, incremental, ready, warm_pool, timer)
+    env.timings = timer.spans[first:]
+    return env, errors
+
+
+async def asmith(
+    func: Function,
+    env: Optional[ToolEnv] = None,
+    docker: Optional[Runtime] = None,
+    cache: Optional[ImageCache] = None,
+    incremental: bool = True,
+    executor: Optional[Executor] = None,
+    ready: Optional[Readiness] = None,
+    warm_pool: Optional[WarmPool] = None,
+    hot_reload: bool = True,
+    result_cache: Optional[ResultCache] = None,
+    timer: Optional[Timer] = None,
+) -> ToolEnv:
+    """Async version of smith, which runs in a worker thread"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        None,
+        functools.partial(
+            smith,
+            func,
+            env,
+            docker=docker,
+            cache=cache,
+            incremental=incremental,
+            executor=executor,
+            ready=ready,
+            warm_pool=warm_pool,
+            hot_reload=hot_reload,
+            result_cache=result_cache,
+            timer=timer,
+        ),
+    )
+
+
+def _image_has_numpy(env: ToolEnv) -> bool:
+    """Whether numpy is installed in env's image (see render_requirements)"""
+    return any(t.arrays for t in env.tools.values()) or "numpy" in requirement_names(
+        cast(str, env.image_requirements)
+    )
+
+
+def _hot_reload(
+    env: ToolEnv, tool: EncodedTool, func_requirements: str, docker: Runtime
+) -> bool:
+    """Add tool to env's running containers through their admin endpoint
+
+    Only possible with one worker per container (the request reaches one process),
+    when no other setting of env changed since its containers were started and
+    when the running image already satisfies func_requirements. Returns False,
+    leaving env unchanged, if tool has to be built into a new image. The running
+    containers then differ from env.image until the next rebuild.
+    """
+    if (
+        docker.mock
+        or env.admin_token is None
+        or env.workers != 1
+        or not env.containers
+        or env.deployed_settings != env.settings_hash()
+        or env.image_requirements is None
+        or not consistent_requirements(env.image_requirements, func_requirements)
+        or (tool.arrays and not _image_has_numpy(env))
+    ):
+        return False
+    endpoint = func_to_url(tool.function_name)
+    try:
+        env.client().add_tool(
+            endpoint, render_tool(endpoint, tool, env.metrics), env.admin_token
+        )
+    except urllib.error.HTTPError as e:
+        # e.g. a replica that does not know the token - rebuilding still works
+        warnings.warn(
+            f"Could not add {endpoint} to running containers ({e}), rebuilding"
+        )
+        return False
+    except (urllib.error.URLError, ConnectionError):
+        return False
+    env.tools[endpoint] = tool
+    return True
+
+
+# one environment to build: a function or the functions of a single environment
+Build = Union[Function, Sequence[Function]]
+
+
+def smith_envs(
+    builds: Sequence[Build],
+    envs: Optional[Sequence[Optional[ToolEnv]]] = None,
+    docker: Optional[Runtime] = None,
+    cache: Optional[ImageCache] = None,
+    incremental: bool = True,
+    ready: Optional[Readiness] = None,
+    max_concurrency: int = 4,
+    warm_pool: Optional[WarmPool] = None,
+    hot_reload: bool = True,
+    result_cache: Optional[ResultCache] = None,
+) -> List[Union[ToolEnv, Exception]]:
+    """Build and start one environment per entry of builds, up to max_concurrency at once
+
+    See asmith_envs.
+    """
+    with ThreadPoolExecutor(max_workers=max_concurrency) as pool:
+        futures = [
+            pool.submit(
+                _smith_env,
+                i,
+                build,
+                env,
+                docker=docker,
+                cache=cache,
+                incremental=incremental,
+                ready=ready,
+                warm_pool=warm_pool,
+                hot_reload=hot_reload,
+                result_cache=result_cache,
+            )
+            for i, (build, env) in enumerate(_pair_envs(builds, envs))
+        ]
+        return [_result(f) for f in futures]
+
+
+async def asmith_envs(
+    builds: Sequence[Build],
+    envs: Optional[Sequence[Optional[ToolEnv]]] = None,
+    docker: Optional[Runtime] = None,
+    cache: Optional[ImageCache] = None,
+    incremental: bool = True,
+    ready: Optional[Readiness] = None,
+    max_concurrency: int = 4,
+    warm_pool: Optional[WarmPool] = None,
+    hot_reload: bool = True,
+    result_cache: Optional[ResultCache] = None,
+) -> List[Union[ToolEnv, Exception]]:
+    """Build and start one environment per entry of builds, up to max_concurrency at once
+
+    Each entry is a function or a list of functions served by one environment,
+    added to the matching entry of envs if given. Environments that are not given
+    are created with a docker-assigned port (port=0), so they can run side by side.
+    The remaining arguments are passed on to smith (or smith_many), and each
+    environment keeps its own phase timings in ``env.timings``.
+
+    Results are in the order of builds; an environment that fails to build or start
+    is returned as its exception without affecting the others.
+    """
+    loop = asyncio.get_running_loop()
+    pool = ThreadPoolExecutor(max_workers=max_concurrency)
+    try:
+        futures = [
+            loop.run_in_executor(
+                pool,
+                functools.partial(
+                    _smith_env,
+                    i,
+                    build,
+                    env,
+                    docker=docker,
+                    cache=cache,
+                    incremental=incremental,
+                    ready=ready,
+                    warm_pool=warm_pool,
+                    hot_reload=hot_reload,
+                    result_cache=result_cache,
+                ),
+            )
+            for i, (build, env) in enumerate(_pair_envs(builds, envs))
+        ]
+        return await asyncio.gather(*futures, return_exceptions=True)
+    finally:
+        pool.shutdown(wait=False)
+
+
+def _pair_envs(
+    builds: Sequence[Build], envs: Optional[Sequence[Optional[ToolEnv]]]
+) -> List[Tuple[Build, Optional[ToolEnv]]]:
+    if envs is None:
+        envs = [None] * len(builds)
+    if len(envs) != len(builds):
+        raise ValueError("Must give one env (or None) per build")
+    return list(zip(builds, envs))
+
+
+def _result(future):
+    try:
+        return future.result()
+    except Exception as e:
+        return e
+
+
+def _smith_env(
+    i: int,
+    build: Build,
+    env: Optional[ToolEnv],
+    docker: Optional[Runtime],
+    cache: Optional[ImageCache],
+    incremental: bool,
+    ready: Optional[Readiness],
+    warm_pool: Optional[WarmPool] = None,
+    hot_reload: bool = True,
+    result_cache: Optional[ResultCache] = None,
+) -> ToolEnv:
+    if docker is None:
+        docker = Docker() if env is None else env.docker
+    if env is None:
+        env = ToolEnv(
+            requirements="", name=f"tool-environment-{i}", port=0, docker=docker
+        )
+    if isinstance(build, str) or callable(build):
+        return smith(
+            build,
+            env,
+            docker=docker,
+            cache=cache,
+            incremental=incremental,
+            ready=ready,
+            warm_pool=warm_pool,
+            hot_reload=hot_reload,
+            result_cache=result_cache,
+        )
+    env, errors = smith_many(
+        build,
+        env,
+        docker=docker,
+        cache=cache,
+        incremental=incremental,
+        ready=ready,
+        warm_pool=warm_pool,
+        result_cache=result_cache,
+    )
+    if errors:
+        # the environment is up, but not with every function asked for
+        env.close()
+        raise ValueError(f"Could not add functions: {errors}")
+    return env
+
+
+def _func_label(func: Function, i: int) -> str:
+    try:
+        return get_func_name(func)
+    except Exception:
+        return f"<function {i}>"
+
+
+# artifact digest -> lock held while its image is built
+_build_locks: Dict[str, threading.Lock] = {}
+_build_locks_lock = threading.Lock()
+
+
+def _build_lock(digest: str) -> threading.Lock:
+    with _build_locks_lock:
+        return _build_locks.setdefault(digest, threading.Lock())
+
+
+def _deploy(
+    env: ToolEnv,
+    server: str,
+    docker: Runtime,
+    cache: Optional[ImageCache],
+    incremental: bool,
+    ready: Optional[Readiness],
+    warm_pool: Optional[WarmPool] = None,
+    timer: Optional[Timer] = None,
+) -> ToolEnv:
+    """Build (unless cached) and start the image serving env's rendered main.py"""
+    if timer is None:
+        timer = Timer()
+    if cache is None and env.save_dir is not None:
+        cache = ImageCache(path=env.save_dir / "images.json")
+    for cid in env.container_ids():
+        docker.remove_container(cid)
+    env.release_ports()
+    registry = env.port_registry()
+    if registry is not None and not env.auto_port:
+        owner = registry.owner(env.port)
+        if (
+            owner is not None
+            and owner != env.port_owner()
+            and not port_is_free(env.port)
+        ):
+            raise ValueError(f"Port {env.port} is used by tool environment {owner}")
+
+    # TODO: this logic should probably be in env
+
+    parent_image: Optional[str] = None
+    base = (env.base_image, env.docker_file_commands)
+    if (
+        incremental
+        and env.image is not None
+        and env.image_requirements is not None
+        and env.image_base == base
+    ):
+        if env.image_requirements == env.requirements:
+            # build from the same parent as env.image, so its layers are reused
+            if env.parent_image is not None and docker.image_exists(env.parent_image):
+                parent_image = env.parent_image
+        elif consistent_requirements(
+            env.requirements, env.image_requirements
+        ) and docker.image_exists(env.image):
+            parent_image = env.image
+
+    with timer.span("render_image", python=True):
+        container = render_container(env, parent_image=parent_image)
+        requirements = render_requirements(env)
+        digest = artifact_hash(container, requirements, server)
+
+    # concurrent builds of the same artifacts wait for the first one to finish
+    with _build_lock(digest):
+        image = cache.get(digest) if cache is not None else None
+        if image is None or not docker.image_exists(image):
+            image = f"{env.name}:{digest[:12]}"
+            # create directory for temp files
+            with tempfile.TemporaryDirectory() as tmpdirname:
+                with open(os.path.join(tmpdirname, "Dockerfile"), "w") as f:
+                    f.write(container)
+                with open(os.path.join(tmpdirname, "main.py"), "w") as f:
+                    f.write(server)
+                with open(os.path.join(tmpdirname, "requirements.txt"), "w") as f:
+                    f.write(requirements)
+                with timer.span("build"):
+                    docker.build_image(image, Path(tmpdirname))
+            if cache is not None:
+                cache.add(digest, image)
+    env.image = image
+    env.image_requirements = env.requirements
+    env.parent_image = parent_image
+    env.image_base = base
+    # first replica is on env.port (unless auto_port), the rest on ports assigned by docker
+    # replicas from the pool were started with its token, so all replicas share it
+    if warm_pool is not None and env.admin_token is not None:
+        env.admin_token = warm_pool.admin_token
+    environment = {}
+    if env.admin_token is not None:
+        environment["AUTOSMITH_ADMIN_TOKEN"] = env.admin_token
+    if warm_pool is not None and not env.auto_port and env.replicas == 1:
+        warnings.warn(
+            f"{env.name} runs on fixed port {env.port}, so warm_pool is not used; "
+            "set port=0 to start from the pool"
+        )
+    env.containers = []
+    with timer.span("start"):
+        for i in range(env.replicas):
+            fixed = i == 0 and not env.auto_port
+            replica = None
+            if warm_pool is not None and not fixed:
+                replica = warm_pool.take(image)
+            if replica is None:
+                cid = docker.run_container(
+                    image, env.port if fixed else None, environment
+                )
+                port = env.port if fixed else docker.container_port(cid)
+                replica = Replica(container_id=cid, port=port)
+            env.containers.append(replica)
+            if registry is not None:
+                registry.register(replica.port, env.port_owner())
+    env.container_id = env.containers[0].container_id
+    env.assign_port(env.containers[0].port)
+    env.deployed_settings = env.settings_hash()
+
+    if ready is None:
+        ready = Readiness()
+    with timer.span("ready"):
+        for replica in env.containers:
+            ready.wait(
+                f"http://{env.host}:{replica.port}", docker, replica.container_id
+            )
 
     return env
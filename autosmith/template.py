@@ -1,16 +1,98 @@
 import ast
+import functools
+import hashlib
 import inspect
 import json
+import os
 import textwrap
+import threading
 import warnings
-from typing import Callable, Optional, Union, cast
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, Callable, Dict, List, Optional, Set, Union, cast
 
-from datamodel_code_generator.parser.jsonschema import JsonSchemaParser
-from jinja2 import Environment, PackageLoader
+from packaging.requirements import Requirement
 from pydantic import BaseModel, create_model
 
-from .env import EncodedTool, ToolEnv
-from .func import consistent_requirements, get_requirements
+from .cache import get_cache_dir
+from .env import EncodedTool, Executor, ResultCache, ToolEnv
+from .func import consistent_requirements, get_requirements, requirement_lines
+
+# jinja2 and datamodel_code_generator are slow to import, so load them on first use
+if TYPE_CHECKING:
+    from jinja2 import Environment
+
+# sha256 of schema JSON -> generated pydantic source
+_compiled_schemas: Dict[str, str] = {}
+_compiled_schemas_lock = threading.Lock()
+_codegen_version_str: Optional[str] = None
+# bumped when compile_schema's output changes, to skip old schemas cached on disk
+_SCHEMA_FORMAT = 2
+
+
+@functools.lru_cache(maxsize=None)
+def _make_jinja_env(cache_dir: Optional[Path]) -> "Environment":
+    from jinja2 import Environment, FileSystemBytecodeCache, PackageLoader
+
+    bytecode_cache = None
+    if cache_dir is not None:
+        (cache_dir / "jinja").mkdir(parents=True, exist_ok=True)
+        bytecode_cache = FileSystemBytecodeCache(str(cache_dir / "jinja"))
+    return Environment(
+        loader=PackageLoader("autosmith", "templates"),
+        bytecode_cache=bytecode_cache,
+        # templates ship with the package, so never check them for changes
+        auto_reload=False,
+    )
+
+
+def get_jinja_env() -> "Environment":
+    """Get the shared jinja environment, which keeps compiled templates
+
+    If a cache dir is set, compiled templates are also kept there as bytecode.
+    """
+    return _make_jinja_env(get_cache_dir())
+
+
+class NDArray:
+    """Schema type of numpy array arguments
+
+    Any value is accepted, so arrays are not validated element by element. The
+    schema is marked with format "ndarray" and the generated server converts the
+    value to a numpy array before calling the function.
+    """
+
+    @classmethod
+    def __get_validators__(cls):
+        yield cls.validate
+
+    @classmethod
+    def validate(cls, v: Any) -> Any:
+        return v
+
+    @classmethod
+    def __modify_schema__(cls, field_schema: Dict[str, Any]):
+        field_schema.update(format="ndarray")
+
+
+def _schema_type(annotation: Any) -> Any:
+    """Type to put in the schema for an argument annotation
+
+    numpy arrays (also numpy.typing.NDArray[...]) become NDArray, without
+    importing numpy.
+    """
+    origin = getattr(annotation, "__origin__", annotation)
+    if (
+        getattr(origin, "__module__", None) == "numpy"
+        and getattr(origin, "__name__", None) == "ndarray"
+    ):
+        return NDArray
+    return annotation
+
+
+def array_fields(schema_json: str) -> List[str]:
+    """Names of the properties of a JSON schema that are numpy arrays"""
+    properties = json.loads(schema_json).get("properties", {})
+    return [k for k, v in properties.items() if v.get("format") == "ndarray"]
 
 
 def make_schema(func: Callable) -> BaseModel:
@@ -26,10 +108,11 @@ def make_schema(func: Callable) -> BaseModel:
             properties[arg] = func.__defaults__[func.__code__.co_varnames.index(arg)]
         # use type hints (no elif - intentional
         if arg in func.__annotations__:
+            annotation = _schema_type(func.__annotations__[arg])
             if arg in properties:
-                properties[arg] = (func.__annotations__[arg], properties[arg])
+                properties[arg] = (annotation, properties[arg])
             else:
-                properties[arg] = (func.__annotations__[arg], ...)
+                properties[arg] = (annotation, ...)
         # use str as default (or rely on type inference from default)
         else:
             properties[arg] = (str, ...)
@@ -46,7 +129,7 @@ def get_func_name(func: Union[Callable, str]) -> str:
     source: str = textwrap.dedent(cast(str, func))
     source_node: ast.AST = ast.parse(source)
     for n in ast.walk(source_node):
-        if isinstance(n, ast.FunctionDef):
+        if isinstance(n, (ast.FunctionDef, ast.AsyncFunctionDef)):
             return n.name
     raise ValueError("Could not find function name")
 
@@ -59,7 +142,7 @@ def get_func_description(func: Union[Callable, str]) -> str:
     source: str = textwrap.dedent(cast(str, func))
     source_node: ast.AST = ast.parse(source)
     for n in ast.walk(source_node):
-        if isinstance(n, ast.FunctionDef):
+        if isinstance(n, (ast.FunctionDef, ast.AsyncFunctionDef)):
             ds = ast.get_docstring(n)
             if ds is None:
                 return ""
@@ -67,35 +150,174 @@ def get_func_description(func: Union[Callable, str]) -> str:
     raise ValueError("Could not find function description")
 
 
+def get_func_executor(func: Union[Callable, str]) -> Executor:
+    """Get how the server should run a function - awaited if async, else in a thread"""
+    if callable(func):
+        if inspect.iscoroutinefunction(func) or inspect.isasyncgenfunction(func):
+            return "async"
+        return "thread"
+
+    source: str = textwrap.dedent(cast(str, func))
+    source_node: ast.AST = ast.parse(source)
+    for n in ast.walk(source_node):
+        if isinstance(n, ast.AsyncFunctionDef):
+            return "async"
+        if isinstance(n, ast.FunctionDef):
+            return "thread"
+    raise ValueError("Could not find function")
+
+
+def _yields(node: ast.AST) -> bool:
+    """Whether a function body yields, not counting nested functions and classes"""
+    for child in ast.iter_child_nodes(node):
+        if isinstance(child, (ast.Yield, ast.YieldFrom)):
+            return True
+        if isinstance(
+            child, (ast.FunctionDef, ast.AsyncFunctionDef, ast.Lambda, ast.ClassDef)
+        ):
+            continue
+        if _yields(child):
+            return True
+    return False
+
+
+def get_func_streams(func: Union[Callable, str]) -> bool:
+    """Get whether a function is a (sync or async) generator, so its results are streamed"""
+    if callable(func):
+        return inspect.isgeneratorfunction(func) or inspect.isasyncgenfunction(func)
+
+    source: str = textwrap.dedent(cast(str, func))
+    source_node: ast.AST = ast.parse(source)
+    for n in ast.walk(source_node):
+        if isinstance(n, (ast.FunctionDef, ast.AsyncFunctionDef)):
+            return _yields(n)
+    raise ValueError("Could not find function")
+
+
+def quote_annotations(source: str) -> str:
+    """Turn the annotations in the signature of a function's source into strings
+
+    The server validates inputs with the schema and never evaluates them, and they
+    may name modules the server does not import (e.g. x: np.ndarray).
+    """
+    tree = ast.parse(source)
+    func = next(
+        (
+            n
+            for n in tree.body
+            if isinstance(n, (ast.FunctionDef, ast.AsyncFunctionDef))
+        ),
+        None,
+    )
+    if func is None:
+        return source
+    args = func.args
+    annotations = [
+        a.annotation
+        for a in args.posonlyargs + args.args + args.kwonlyargs
+        if a.annotation is not None
+    ]
+    for a in (args.vararg, args.kwarg):
+        if a is not None and a.annotation is not None:
+            annotations.append(a.annotation)
+    if func.returns is not None:
+        annotations.append(func.returns)
+    # ast offsets are in bytes of utf-8
+    data = source.encode("utf-8")
+    line_starts = [0]
+    for line in data.splitlines(keepends=True):
+        line_starts.append(line_starts[-1] + len(line))
+    for node in sorted(
+        annotations, key=lambda n: (n.lineno, n.col_offset), reverse=True
+    ):
+        if isinstance(node, ast.Constant) and isinstance(node.value, str):
+            continue
+        start = line_starts[node.lineno - 1] + node.col_offset
+        end = line_starts[cast(int, node.end_lineno) - 1] + cast(
+            int, node.end_col_offset
+        )
+        text = " ".join(data[start:end].decode("utf-8").split())
+        data = data[:start] + repr(text).encode("utf-8") + data[end:]
+    return data.decode("utf-8")
+
+
 def func_to_url(name: str) -> str:
     return name.replace("_", "-")
 
 
-def render_server(
+def _codegen_version() -> str:
+    global _codegen_version_str
+    if _codegen_version_str is None:
+        import importlib_metadata
+
+        _codegen_version_str = importlib_metadata.version("datamodel-code-generator")
+    return _codegen_version_str
+
+
+def compile_schema(schema_json: str) -> str:
+    """Generate pydantic model source from a JSON schema
+
+    Code generation is slow, so results are cached by schema hash in memory and,
+    if a cache dir is set, on disk.
+    """
+    key = hashlib.sha256(schema_json.encode("utf-8")).hexdigest()
+    with _compiled_schemas_lock:
+        if key in _compiled_schemas:
+            return _compiled_schemas[key]
+    path: Optional[Path] = None
+    cache_dir = get_cache_dir()
+    if cache_dir is not None:
+        path = cache_dir / "schemas" / f"{_codegen_version()}-{_SCHEMA_FORMAT}-{key}.py"
+    if path is not None and path.exists():
+        raw_schema = path.read_text()
+    else:
+        from datamodel_code_generator.parser.jsonschema import JsonSchemaParser
+
+        parser = JsonSchemaParser(schema_json)
+        # every model, nested ones before those that use them
+        raw_schema = cast(str, parser.parse(with_import=False, format_=False))
+        raw_schema = raw_schema.strip()
+        if path is not None:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = path.with_suffix(f".{os.getpid()}.tmp")
+            tmp.write_text(raw_schema)
+            os.replace(tmp, path)
+    with _compiled_schemas_lock:
+        _compiled_schemas[key] = raw_schema
+    return raw_schema
+
+
+def encode_tool(
     func: Union[Callable, str],
     schema: Optional[Union[BaseModel, str]] = None,
-    tool_env: Optional[ToolEnv] = None,
-) -> str:
-    """Stamp a function with a schema and tool environment"""
+    executor: Optional[Executor] = None,
+    result_cache: Optional[ResultCache] = None,
+) -> EncodedTool:
+    """Encode a function and its schema (inferred if not given) as a tool
+
+    executor is one of "thread", "process" or "async" and is detected from func if not given.
+    result_cache turns on caching of the function's results by the server.
+    Results of generators are streamed, so they cannot be cached or use processes.
+    """
     if isinstance(func, str) and schema is None:
         raise ValueError("Must provide schema if func is a string")
     raw_schema: Optional[str] = None
     schema_title: str = ""
+    arrays: List[str] = []
     if schema is None:
         schema = make_schema(cast(Callable, func))
     if not isinstance(schema, str):
         schema_title = schema.__name__
-        parser = JsonSchemaParser(schema.schema_json())
-        parser.parse_raw()
-        raw_schema = parser.results[0].render()
+        schema_json = schema.schema_json()
+        raw_schema = compile_schema(schema_json)
+        arrays = array_fields(schema_json)
     else:
         schema = cast(str, schema)
         # check if schema is valid json
         try:
             schema_title = json.loads(schema)["title"]
-            parser = JsonSchemaParser(schema)
-            parser.parse_raw()
-            raw_schema = parser.results[0].render()
+            raw_schema = compile_schema(schema)
+            arrays = array_fields(schema)
         except json.JSONDecodeError:
             # if not, assume it's python code
             raw_schema = textwrap.dedent(schema)
@@ -103,46 +325,107 @@ def render_server(
                 raw_schema.split("(BaseModel):")[0].split("class ")[1].strip()
             )
 
-    func_requirements = get_requirements(func)
-    env = Environment(loader=PackageLoader("autosmith", "templates"))
-
-    if not tool_env:
-        tool_env = ToolEnv(requirements=func_requirements, tools={})
-
-    if not consistent_requirements(tool_env.requirements, func_requirements):
-        raise ValueError("Requirements are not consistent")
-
     if callable(func):
         source = textwrap.dedent(inspect.getsource(func))
     else:
         source = textwrap.dedent(func)
+    source = quote_annotations(source)
+
+    stream = get_func_streams(func)
+    if stream and result_cache is not None:
+        raise ValueError("Results of generators cannot be cached")
+    executor = executor or get_func_executor(func)
+    if stream and executor == "process":
+        raise ValueError("Generators cannot run in a process pool")
 
     # convert schema and func to tool
-    tool = EncodedTool(
+    return EncodedTool(
         function=source,
         function_name=get_func_name(func),
         description=get_func_description(func),
         input_class_name=schema_title,
         input_class_raw_schema=raw_schema,
+        executor=executor,
+        result_cache=result_cache,
+        arrays=arrays,
+        stream=stream,
     )
 
+
+def render_server(
+    func: Union[Callable, str],
+    schema: Optional[Union[BaseModel, str]] = None,
+    tool_env: Optional[ToolEnv] = None,
+    executor: Optional[Executor] = None,
+    result_cache: Optional[ResultCache] = None,
+) -> str:
+    """Stamp a function with a schema and tool environment
+
+    executor is one of "thread", "process" or "async" and is detected from func if not given.
+    """
+    tool = encode_tool(func, schema, executor, result_cache)
+
+    func_requirements = get_requirements(func)
+
+    if not tool_env:
+        tool_env = ToolEnv(requirements=func_requirements, tools={})
+
+    if not consistent_requirements(tool_env.requirements, func_requirements):
+        raise ValueError("Requirements are not consistent")
+
     # add tool to tool_env
     tool_env.tools[func_to_url(tool.function_name)] = tool
 
-    # render tool_env
-    template = env.get_template("main.py.jinja")
-    return template.render(env=tool_env)
+    return render_main(tool_env)
+
+
+def render_tool(endpoint: str, tool: EncodedTool, metrics: bool = False) -> str:
+    """Render the server code for one tool, timing its calls if metrics
+
+    The result is stored on the tool and reused until a field of the tool is set or
+    the endpoint changes.
+    """
+    key = f"{endpoint}\0{metrics}"
+    if tool._rendered is not None and tool._rendered[0] == key:
+        return tool._rendered[1]
+    template = get_jinja_env().get_template("tool.py.jinja")
+    block = template.render(endpoint=endpoint, tool=tool, metrics=metrics)
+    tool._rendered = (key, block)
+    return block
+
+
+def render_main(tool_env: ToolEnv) -> str:
+    """Render main.py serving every tool in tool_env"""
+    blocks = [
+        render_tool(endpoint, tool, tool_env.metrics)
+        for endpoint, tool in tool_env.tools.items()
+    ]
+    template = get_jinja_env().get_template("main.py.jinja")
+    return template.render(env=tool_env, blocks=blocks)
 
 
-def render_container(tool_env: ToolEnv) -> str:
-    """template a container with a tool environment"""
-    env = Environment(loader=PackageLoader("autosmith", "templates"))
-    template = env.get_template("Dockerfile.jinja")
-    return template.render(env=tool_env)
+def render_container(tool_env: ToolEnv, parent_image: Optional[str] = None) -> str:
+    """template a container with a tool environment
+
+    If parent_image is given, the container is built on top of it instead of
+    base_image, so only requirements missing from the parent are installed.
+    """
+    template = get_jinja_env().get_template("Dockerfile.jinja")
+    return template.render(env=tool_env, parent_image=parent_image)
+
+
+def requirement_names(requirements: str) -> Set[str]:
+    """Lowercase names of the packages in a requirements.txt"""
+    return {Requirement(line).name.lower() for line in requirement_lines(requirements)}
 
 
 def render_requirements(tool_env: ToolEnv) -> str:
-    """Render requirements.txt from tool_env"""
-    env = Environment(loader=PackageLoader("autosmith", "templates"))
-    template = env.get_template("requirements.txt.jinja")
-    return template.render(env=tool_env)
+    """Render requirements.txt from tool_env
+
+    numpy is added if a tool takes arrays and the requirements do not name it.
+    """
+    numpy = any(t.arrays for t in tool_env.tools.values()) and (
+        "numpy" not in requirement_names(tool_env.requirements)
+    )
+    template = get_jinja_env().get_template("requirements.txt.jinja")
+    return template.render(env=tool_env, numpy=numpy)
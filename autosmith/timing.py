@@ -0,0 +1,67 @@
+import contextlib
+import cProfile
+import pstats
+import time
+from typing import Callable, Dict, Iterator, List, Optional
+
+from pydantic import BaseModel, PrivateAttr
+
+
+class Span(BaseModel):
+    """Span is one timed phase of smith"""
+
+    name: str
+    # wall clock time the phase started at and how long it took, in seconds
+    start: float
+    duration: float
+
+
+class Timer(BaseModel):
+    """Timer records how long each phase of smith takes
+
+    Phases are "requirements", "schema", "render", "hot_reload", "render_image",
+    "build" (only if an image was built), "start" and "ready". on_span is called
+    with every finished span. If profile, the phases that run Python code of
+    autosmith (requirements, schema, render and render_image) are profiled with
+    cProfile, see stats.
+    """
+
+    on_span: Optional[Callable[[Span], None]] = None
+    profile: bool = False
+    spans: List[Span] = []
+    _profiler: Optional[cProfile.Profile] = PrivateAttr(None)
+
+    @contextlib.contextmanager
+    def span(self, name: str, python: bool = False) -> Iterator[None]:
+        """Time the enclosed block as a phase, profiling it if python and profile"""
+        profiler = None
+        if python and self.profile:
+            if self._profiler is None:
+                self._profiler = cProfile.Profile()
+            profiler = self._profiler
+            profiler.enable()
+        start = time.time()
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            duration = time.perf_counter() - t0
+            if profiler is not None:
+                profiler.disable()
+            span = Span(name=name, start=start, duration=duration)
+            self.spans.append(span)
+            if self.on_span is not None:
+                self.on_span(span)
+
+    def totals(self) -> Dict[str, float]:
+        """Total seconds spent in each phase"""
+        totals: Dict[str, float] = {}
+        for span in self.spans:
+            totals[span.name] = totals.get(span.name, 0.0) + span.duration
+        return totals
+
+    def stats(self) -> pstats.Stats:
+        """Profile of the Python phases (needs profile=True)"""
+        if self._profiler is None:
+            raise ValueError("Nothing was profiled")
+        return pstats.Stats(self._profiler)
@@ -0,0 +1,167 @@
+"""Benchmark the throughput and latency of a generated server under local load
+
+A main.py with a few representative tools is rendered, imported and served by
+uvicorn in this process; client threads with keep-alive connections then call
+one tool at a time for a fixed duration. Needs fastapi and uvicorn installed.
+Client and server share the interpreter, so compare results from the same
+machine and settings only.
+
+    python -m benchmarks.bench_server --duration 5 --concurrency 16 --output server.json
+"""
+import argparse
+import http.client
+import importlib.util
+import socket
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+from typing import Dict, List
+
+from autosmith.env import ResultCache, ToolEnv
+from autosmith.template import encode_tool, func_to_url, render_main
+
+from .common import percentile, write_results
+
+
+def echo(x: int):
+    """Return x (sync, runs in the thread pool)"""
+    return x
+
+
+async def aecho(x: int):
+    """Return x (async, awaited on the event loop)"""
+    return x
+
+
+def cached(x: int):
+    """Return x (sync, behind the result cache)"""
+    return x
+
+
+def work(x: int):
+    """Sum the first x integers (sync, some CPU per call)"""
+    return sum(range(x))
+
+
+# tool -> query string of each call
+TOOLS = {
+    "echo": (echo, "x=1", None),
+    "aecho": (aecho, "x=1", None),
+    "cached": (cached, "x=1", ResultCache()),
+    "work": (work, "x=10000", None),
+}
+
+
+def serve(env: ToolEnv, directory: Path):
+    """Render and import main.py for env and serve it on a free port"""
+    import uvicorn
+
+    path = directory / "main.py"
+    path.write_text(render_main(env))
+    spec = importlib.util.spec_from_file_location("autosmith_bench_main", path)
+    assert spec is not None and spec.loader is not None
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[spec.name] = module
+    spec.loader.exec_module(module)
+
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    server = uvicorn.Server(
+        uvicorn.Config(module.app, port=port, log_level="warning", lifespan="off")
+    )
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.01)
+    return server, thread, port
+
+
+def load(port: int, path: str, duration: float, concurrency: int) -> Dict[str, float]:
+    """Call path from concurrency threads for duration seconds"""
+    latencies: List[List[float]] = [[] for _ in range(concurrency)]
+    errors = [0] * concurrency
+    start_barrier = threading.Barrier(concurrency + 1)
+    deadline = [0.0]
+
+    def worker(i: int):
+        conn = http.client.HTTPConnection("127.0.0.1", port)
+        start_barrier.wait()
+        while time.perf_counter() < deadline[0]:
+            t0 = time.perf_counter()
+            try:
+                conn.request("GET", path)
+                response = conn.getresponse()
+                response.read()
+                if response.status != 200:
+                    errors[i] += 1
+            except (OSError, http.client.HTTPException):
+                errors[i] += 1
+                conn.close()
+                conn = http.client.HTTPConnection("127.0.0.1", port)
+                continue
+            latencies[i].append(time.perf_counter() - t0)
+        conn.close()
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(concurrency)]
+    for t in threads:
+        t.start()
+    start = time.perf_counter()
+    deadline[0] = start + duration
+    start_barrier.wait()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - start
+    samples = [latency for worker in latencies for latency in worker]
+    return {
+        "requests": len(samples),
+        "errors": sum(errors),
+        "rps": len(samples) / elapsed,
+        "p50_ms": percentile(samples, 50) * 1000,
+        "p90_ms": percentile(samples, 90) * 1000,
+        "p99_ms": percentile(samples, 99) * 1000,
+        "max_ms": max(samples, default=float("nan")) * 1000,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--duration", type=float, default=5.0)
+    parser.add_argument("--warmup", type=float, default=0.5)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--tools", nargs="+", default=list(TOOLS))
+    parser.add_argument(
+        "--metrics", action="store_true", help="serve with ToolEnv(metrics=True)"
+    )
+    parser.add_argument("--output", help="JSON file to write (default stdout)")
+    args = parser.parse_args(argv)
+
+    env = ToolEnv(requirements="", metrics=args.metrics, save_dir=None)
+    for name in args.tools:
+        func, _, result_cache = TOOLS[name]
+        env.tools[func_to_url(name)] = encode_tool(func, result_cache=result_cache)
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        server, thread, port = serve(env, Path(tmp))
+        try:
+            for name in args.tools:
+                path = f"/{func_to_url(name)}?{TOOLS[name][1]}"
+                load(port, path, args.warmup, args.concurrency)
+                metrics = load(port, path, args.duration, args.concurrency)
+                results.append({"name": f"server/{name}", "metrics": metrics})
+                print(
+                    f"{name}: {metrics['rps']:.0f} req/s, "
+                    f"p99 {metrics['p99_ms']:.2f} ms",
+                    file=sys.stderr,
+                )
+        finally:
+            server.should_exit = True
+            thread.join()
+    write_results("server", vars(args), results, args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,137 @@
+"""Benchmark the smith pipeline on synthetic modules with the mock Docker backend
+
+Nothing is built or started, so the timings are of autosmith itself: requirement
+resolution, schema codegen and rendering. Each size is run "cold" (in-memory
+caches cleared) and "warm" (the same functions again).
+
+    python -m benchmarks.bench_smith --sizes 1 10 100 500 --output smith.json
+"""
+import argparse
+import importlib.util
+import sys
+import tempfile
+import textwrap
+import time
+from pathlib import Path
+from typing import Callable, Dict, List
+
+from autosmith import func as autosmith_func
+from autosmith import template
+from autosmith.cache import ImageCache, set_cache_dir
+from autosmith.docker import Docker
+from autosmith.env import ToolEnv
+from autosmith.smith import smith, smith_many
+from autosmith.timing import Timer
+
+from .common import median_metrics, write_results
+
+TOOL = '''
+def tool_{tag}_{i}(x: int, y: float = 1.0, name: str = "tool"):
+    """Synthetic tool {i}, scales the square root of x by y"""
+    return json.dumps({{"name": name, "value": math.sqrt(abs(x)) * y}})
+'''
+
+
+def make_module(directory: Path, tag: str, n: int) -> List[Callable]:
+    """Write and import a module with n functions, returning them"""
+    name = f"autosmith_bench_{tag}"
+    source = "import json\nimport math\n\nfrom packaging.version import Version\n"
+    source += "".join(textwrap.dedent(TOOL).format(tag=tag, i=i) for i in range(n))
+    path = directory / f"{name}.py"
+    path.write_text(source)
+    spec = importlib.util.spec_from_file_location(name, path)
+    assert spec is not None and spec.loader is not None
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return [getattr(module, f"tool_{tag}_{i}") for i in range(n)]
+
+
+def clear_caches():
+    """Forget everything autosmith caches in memory between calls"""
+    template._compiled_schemas.clear()
+    autosmith_func._module_imports.clear()
+    autosmith_func.clear_distribution_cache()
+
+
+def run_many(funcs: List[Callable], directory: Path) -> Dict[str, float]:
+    """smith_many over all funcs, returning seconds per phase and in total"""
+    timer = Timer()
+    env = ToolEnv(requirements="", save_dir=directory, docker=Docker(mock=True))
+    start = time.perf_counter()
+    smith_many(
+        funcs,
+        env=env,
+        docker=env.docker,
+        cache=ImageCache(path=directory / "images.json"),
+        timer=timer,
+    )
+    total = time.perf_counter() - start
+    metrics = {f"{name}_s": seconds for name, seconds in timer.totals().items()}
+    metrics["total_s"] = total
+    return metrics
+
+
+def run_incremental(funcs: List[Callable], directory: Path) -> Dict[str, float]:
+    """smith one function at a time into the same env"""
+    timer = Timer()
+    env = ToolEnv(requirements="", save_dir=directory, docker=Docker(mock=True))
+    cache = ImageCache(path=directory / "images.json")
+    start = time.perf_counter()
+    for f in funcs:
+        env = smith(f, env=env, docker=env.docker, cache=cache, timer=timer)
+    total = time.perf_counter() - start
+    metrics = {f"{name}_s": seconds for name, seconds in timer.totals().items()}
+    metrics["total_s"] = total
+    metrics["per_function_s"] = total / len(funcs)
+    return metrics
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1, 10, 100, 500])
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument(
+        "--incremental-max",
+        type=int,
+        default=100,
+        help="largest size to also add one function at a time",
+    )
+    parser.add_argument("--output", help="JSON file to write (default stdout)")
+    args = parser.parse_args(argv)
+
+    set_cache_dir(None)
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        directory = Path(tmp)
+        for n in args.sizes:
+            cold, warm, incremental = [], [], []
+            for r in range(args.repeat):
+                run_dir = directory / f"{n}-{r}"
+                run_dir.mkdir()
+                funcs = make_module(run_dir, f"{n}_{r}", n)
+                clear_caches()
+                cold.append(run_many(funcs, run_dir))
+                warm.append(run_many(funcs, run_dir))
+                if n <= args.incremental_max:
+                    clear_caches()
+                    incremental.append(run_incremental(funcs, run_dir))
+            results.append(
+                {"name": f"smith_many/n={n}/cold", "metrics": median_metrics(cold)}
+            )
+            results.append(
+                {"name": f"smith_many/n={n}/warm", "metrics": median_metrics(warm)}
+            )
+            if incremental:
+                results.append(
+                    {
+                        "name": f"smith/n={n}/incremental",
+                        "metrics": median_metrics(incremental),
+                    }
+                )
+            print(f"n={n}: {median_metrics(cold)['total_s']:.3f} s", file=sys.stderr)
+    write_results("smith", vars(args), results, args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+import datetime
+import json
+import platform
+import statistics
+import subprocess
+import sys
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+from autosmith.version import __version__
+
+
+def metadata() -> Dict[str, Any]:
+    """Where and on what a benchmark ran, so results can be compared across commits"""
+    root = Path(__file__).resolve().parent.parent
+    commit: Optional[str] = None
+    dirty: Optional[bool] = None
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=root,
+            capture_output=True,
+            check=True,
+            text=True,
+        ).stdout.strip()
+        dirty = bool(
+            subprocess.run(
+                ["git", "status", "--porcelain", "--untracked-files=no"],
+                cwd=root,
+                capture_output=True,
+                check=True,
+                text=True,
+            ).stdout.strip()
+        )
+    except (OSError, subprocess.CalledProcessError):
+        pass
+    return {
+        "commit": commit,
+        "dirty": dirty,
+        "autosmith": __version__,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "time": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+    }
+
+
+def percentile(values: List[float], q: float) -> float:
+    """q-th percentile (0-100) of values by nearest rank"""
+    ordered = sorted(values)
+    if not ordered:
+        return float("nan")
+    rank = max(int(round(q / 100 * len(ordered))) - 1, 0)
+    return ordered[min(rank, len(ordered) - 1)]
+
+
+def median_metrics(runs: List[Dict[str, float]]) -> Dict[str, float]:
+    """Median of each metric over repeated runs"""
+    names = sorted({name for run in runs for name in run})
+    return {
+        name: statistics.median(run.get(name, 0.0) for run in runs) for name in names
+    }
+
+
+def write_results(
+    benchmark: str,
+    config: Dict[str, Any],
+    results: List[Dict[str, Any]],
+    output: Optional[str],
+):
+    """Write results as JSON to output, or stdout if None
+
+    Each result is {"name": ..., "metrics": {metric: value}}; see compare.py.
+    """
+    document = {
+        "benchmark": benchmark,
+        "meta": metadata(),
+        "config": config,
+        "results": results,
+    }
+    text = json.dumps(document, indent=2, sort_keys=True)
+    if output is None:
+        sys.stdout.write(text + "\n")
+    else:
+        Path(output).write_text(text + "\n")
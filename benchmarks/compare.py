@@ -0,0 +1,62 @@
+"""Compare two benchmark result files, e.g. from two commits
+
+    python -m benchmarks.compare base.json new.json --threshold 0.1 --fail
+
+Metrics named rps are better when higher, all others (seconds, milliseconds,
+errors) when lower. Changes worse than threshold are marked as regressions.
+"""
+import argparse
+import json
+import sys
+from typing import Dict, List, Tuple
+
+
+def higher_is_better(metric: str) -> bool:
+    return metric == "rps" or metric == "requests"
+
+
+def compare(
+    base: Dict, new: Dict, threshold: float
+) -> List[Tuple[str, str, float, float, float, bool]]:
+    """(result, metric, base, new, relative change, regression) for shared metrics"""
+    base_results = {r["name"]: r["metrics"] for r in base["results"]}
+    rows = []
+    for result in new["results"]:
+        old_metrics = base_results.get(result["name"])
+        if old_metrics is None:
+            continue
+        for metric, value in sorted(result["metrics"].items()):
+            old = old_metrics.get(metric)
+            if old is None:
+                continue
+            change = (value - old) / old if old else 0.0
+            worse = -change if higher_is_better(metric) else change
+            rows.append((result["name"], metric, old, value, change, worse > threshold))
+    return rows
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("base")
+    parser.add_argument("new")
+    parser.add_argument("--threshold", type=float, default=0.1)
+    parser.add_argument(
+        "--fail", action="store_true", help="exit with 1 if anything regressed"
+    )
+    args = parser.parse_args(argv)
+
+    with open(args.base) as f:
+        base = json.load(f)
+    with open(args.new) as f:
+        new = json.load(f)
+    rows = compare(base, new, args.threshold)
+    print(f"base {base['meta'].get('commit')}  new {new['meta'].get('commit')}")
+    for name, metric, old, value, change, regression in rows:
+        mark = "  REGRESSION" if regression else ""
+        print(f"{name:40} {metric:16} {old:12.4g} {value:12.4g} {change:+8.1%}{mark}")
+    if args.fail and any(row[-1] for row in rows):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -22,6 +22,7 @@ setup(
         "pydantic",
         "datamodel_code_generator",
         "importlib_metadata",
+        "packaging",
     ],
     test_suite="tests",
     long_description=long_description,
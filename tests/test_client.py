@@ -0,0 +1,245 @@
+import io
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from autosmith.client import (
+    NPY,
+    Replica,
+    ToolClient,
+    decode_body,
+    encode_body,
+    parse_metrics,
+)
+from autosmith.docker import Docker
+from autosmith.env import ToolEnv
+
+
+class EchoHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = json.dumps({"port": self.server.server_port, "path": self.path}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        inputs = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        body = json.dumps([{"path": self.path, "input": i} for i in inputs]).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def servers():
+    started = [ThreadingHTTPServer(("127.0.0.1", 0), EchoHandler) for _ in range(2)]
+    for s in started:
+        threading.Thread(target=s.serve_forever, daemon=True).start()
+    yield started
+    for s in started:
+        s.shutdown()
+        s.server_close()
+
+
+class StoppedDocker(Docker):
+    """Reports containers named 'dead' as not running"""
+
+    def is_running(self, cid):
+        return cid != "dead"
+
+
+def test_round_robin(servers):
+    replicas = [
+        Replica(container_id=str(i), port=s.server_port) for i, s in enumerate(servers)
+    ]
+    client = ToolClient("127.0.0.1", replicas, Docker(mock=True))
+    ports = [client.call("double", x=2)["port"] for _ in range(4)]
+    assert ports == [s.server_port for s in servers] * 2
+    assert client.call("double", x=2)["path"] == "/double?x=2"
+
+
+def test_batch(servers):
+    replicas = [Replica(container_id="0", port=servers[0].server_port)]
+    client = ToolClient("127.0.0.1", replicas, Docker(mock=True))
+    results = client.batch("double", [{"x": 1}, {"x": 2}])
+    assert results == [{"path": "/double/batch", "input": {"x": i}} for i in (1, 2)]
+
+
+def test_drop_stopped_replica(servers):
+    # nothing listens on a closed server's port
+    closed = servers.pop()
+    closed.shutdown()
+    closed.server_close()
+    replicas = [
+        Replica(container_id="dead", port=closed.server_port),
+        Replica(container_id="alive", port=servers[0].server_port),
+    ]
+    client = ToolClient("127.0.0.1", replicas, StoppedDocker(mock=True))
+    assert client.call("double", x=2)["port"] == servers[0].server_port
+    assert [r.container_id for r in client.replicas] == ["alive"]
+
+    client = ToolClient("127.0.0.1", replicas, StoppedDocker(mock=True))
+    assert [r.container_id for r in client.healthy()] == ["alive"]
+
+
+def test_env_client():
+    env = ToolEnv(requirements="", replicas=2)
+    with pytest.raises(ValueError):
+        env.client()
+    env.container_id = "mock"
+    assert env.client().replicas == [Replica(container_id="mock", port=env.port)]
+
+
+def test_env_client_reused(servers, tmp_path):
+    replicas = [
+        Replica(container_id=str(i), port=s.server_port) for i, s in enumerate(servers)
+    ]
+    env = ToolEnv(
+        requirements="",
+        containers=replicas,
+        docker=Docker(mock=True),
+        save_dir=tmp_path,
+    )
+    paths = [r["path"] for r in env.batch("double", [{"x": 1}])]
+    assert paths == ["/double/batch"]
+    assert env.client() is env.client()
+    ports = [env.client().call("double", x=2)["port"] for _ in range(2)]
+    assert ports == [servers[1].server_port, servers[0].server_port]
+
+    env.save()
+    assert ToolEnv.load(env.name, save_dir=tmp_path).client() is not env.client()
+
+    client = env.client()
+    env.containers = replicas[:1]
+    assert env.client() is not client
+    assert env.client().replicas == replicas[:1]
+
+
+class CacheStatsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = json.dumps({"double": {"hits": 3, "misses": 1, "size": 1}}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def test_cache_stats():
+    started = [
+        ThreadingHTTPServer(("127.0.0.1", 0), CacheStatsHandler) for _ in range(2)
+    ]
+    for s in started:
+        threading.Thread(target=s.serve_forever, daemon=True).start()
+    replicas = [
+        Replica(container_id=str(i), port=s.server_port) for i, s in enumerate(started)
+    ]
+    client = ToolClient("127.0.0.1", replicas, Docker(mock=True))
+    assert client.cache_stats() == {"double": {"hits": 6, "misses": 2, "size": 2}}
+    for s in started:
+        s.shutdown()
+        s.server_close()
+
+
+METRICS = """# HELP autosmith_tool_requests_total Requests by response status
+# TYPE autosmith_tool_requests_total counter
+autosmith_tool_requests_total{tool="double",status="200"} 3
+autosmith_tool_requests_total{tool="double",status="422"} 1
+autosmith_tool_exec_seconds_bucket{tool="double",le="+Inf"} 3
+autosmith_tool_exec_seconds_sum{tool="double"} 0.5
+autosmith_tool_exec_seconds_count{tool="double"} 3
+"""
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = METRICS.encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def test_parse_metrics():
+    samples = parse_metrics(METRICS)
+    assert samples[0] == (
+        "autosmith_tool_requests_total",
+        {"tool": "double", "status": "200"},
+        3.0,
+    )
+    assert samples[2][1]["le"] == "+Inf"
+    assert len(samples) == 5
+
+
+def test_stats():
+    started = [ThreadingHTTPServer(("127.0.0.1", 0), MetricsHandler) for _ in range(2)]
+    for s in started:
+        threading.Thread(target=s.serve_forever, daemon=True).start()
+    env = ToolEnv(
+        requirements="",
+        containers=[
+            Replica(container_id=str(i), port=s.server_port)
+            for i, s in enumerate(started)
+        ],
+        docker=Docker(mock=True),
+    )
+    with pytest.raises(ValueError):
+        env.stats()
+    env.metrics = True
+    env.workers = 2
+    with pytest.raises(ValueError):
+        env.stats()
+    with pytest.raises(ValueError):
+        env.cache_stats()
+    with pytest.raises(ValueError):
+        ToolEnv(requirements="", workers=2, metrics=True)
+    env.workers = 1
+    assert env.stats() == {
+        "double": {
+            "requests_total": 8.0,
+            "exec_seconds_sum": 1.0,
+            "exec_seconds_count": 6.0,
+        }
+    }
+    for s in started:
+        s.shutdown()
+        s.server_close()
+
+
+def test_encode_body():
+    data, content_type = encode_body({"x": 1})
+    assert decode_body(data, content_type) == {"x": 1}
+    with pytest.raises(ValueError):
+        encode_body({"x": 1}, "xml")
+
+    numpy = pytest.importorskip("numpy")
+    pytest.importorskip("msgpack")
+    x = numpy.arange(6, dtype=numpy.float32).reshape(2, 3)
+    data, content_type = encode_body({"x": x, "b": b"\x00"}, "msgpack")
+    assert content_type == "application/msgpack"
+    decoded = decode_body(data, "application/msgpack")
+    assert decoded["b"] == b"\x00"
+    assert decoded["x"].dtype == x.dtype
+    assert (decoded["x"] == x).all()
+    # JSON sends arrays as lists
+    assert decode_body(*encode_body({"x": x})) == {"x": x.tolist()}
+
+    buffer = io.BytesIO()
+    numpy.save(buffer, x)
+    assert (decode_body(buffer.getvalue(), NPY) == x).all()
@@ -0,0 +1,183 @@
+import json
+import socketserver
+import tarfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler
+from io import BytesIO
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+
+from autosmith.docker import Docker
+
+
+class FakeEngineHandler(BaseHTTPRequestHandler):
+    """Minimal stand-in for the Docker Engine API"""
+
+    protocol_version = "HTTP/1.1"
+
+    def reply(self, status, body=None):
+        data = b"" if body is None else json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def record(self):
+        url = urlparse(self.path)
+        length = int(self.headers.get("Content-Length", 0))
+        body = self.rfile.read(length) if length else b""
+        self.server.requests.append((self.command, url.path, parse_qs(url.query), body))
+        self.server.connections.add(self.client_address or id(self.connection))
+        return url.path, parse_qs(url.query), body
+
+    def do_GET(self):
+        path, query, _ = self.record()
+        containers = self.server.containers
+        if path == "/containers/json":
+            ancestor = json.loads(query["filters"][0])["ancestor"][0]
+            self.reply(
+                200,
+                [{"Id": cid} for cid, image in containers.items() if image == ancestor],
+            )
+        elif path.startswith("/containers/") and path.split("/")[2] in containers:
+            ports = {"8080/tcp": [{"HostIp": "0.0.0.0", "HostPort": "49153"}]}
+            self.reply(
+                200, {"State": {"Running": True}, "NetworkSettings": {"Ports": ports}}
+            )
+        elif path.startswith("/images/") and path.split("/")[2] in self.server.images:
+            self.reply(200, {})
+        else:
+            self.reply(404, {"message": "not found"})
+
+    def do_POST(self):
+        path, query, body = self.record()
+        if self.server.drop_posts:
+            # connection reset after the request was handled
+            self.close_connection = True
+            return
+        if path == "/build":
+            names = tarfile.open(fileobj=BytesIO(body)).getnames()
+            self.server.images.add(query["t"][0])
+            # streamed, chunked build output
+            self.send_response(200)
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            for message in [
+                {"stream": "Step 1/1\n"},
+                {"stream": " ".join(sorted(names)) + "\n"},
+            ]:
+                chunk = json.dumps(message).encode() + b"\r\n"
+                self.wfile.write(b"%x\r\n%s\r\n" % (len(chunk), chunk))
+            self.wfile.write(b"0\r\n\r\n")
+        elif path == "/containers/create":
+            cid = f"c{len(self.server.containers)}"
+            self.server.containers[cid] = json.loads(body)["Image"]
+            self.reply(201, {"Id": cid})
+        elif path.endswith("/start"):
+            self.reply(204)
+        else:
+            self.reply(404, {"message": "not found"})
+
+    def do_DELETE(self):
+        path, _, _ = self.record()
+        name = path.split("/")[2]
+        if path.startswith("/containers/"):
+            self.server.containers.pop(name, None)
+        else:
+            self.server.images.discard(name)
+        self.reply(204)
+
+    def log_message(self, *args):
+        pass
+
+    def handle_one_request(self):
+        # like the daemon closing an idle keep-alive connection
+        self.connection.settimeout(0.05 if self.server.close_idle else None)
+        super().handle_one_request()
+
+
+class FakeEngine(socketserver.ThreadingUnixStreamServer):
+    # clients keep their connection open, so don't wait on handlers at close
+    daemon_threads = True
+    block_on_close = False
+
+
+@pytest.fixture
+def engine(tmp_path):
+    server = FakeEngine(str(tmp_path / "docker.sock"), FakeEngineHandler)
+    server.requests = []
+    server.connections = set()
+    server.containers = {}
+    server.images = set()
+    server.close_idle = False
+    server.drop_posts = False
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_api_backend(engine, tmp_path):
+    docker = Docker(backend="api", socket=tmp_path / "docker.sock")
+    assert not docker.mock
+
+    context = tmp_path / "context"
+    context.mkdir()
+    (context / "Dockerfile").write_text("FROM scratch")
+    output = []
+    docker.build_image("env:abc", context, on_output=output.append)
+    assert output[0] == "Step 1/1\n"
+    assert "./Dockerfile" in output[1]
+    assert docker.image_exists("env:abc")
+    assert not docker.image_exists("env:def")
+
+    cid = docker.run_container("env:abc", 9000)
+    create = [r for r in engine.requests if r[1] == "/containers/create"][0]
+    assert (
+        json.loads(create[3])["HostConfig"]["PortBindings"]["8080/tcp"][0]["HostPort"]
+        == "9000"
+    )
+    assert docker.is_running(cid)
+    assert docker.container_port(cid) == 49153
+
+    docker.run_container("env:abc")
+    docker.remove_image("env:abc")
+    assert engine.containers == {}
+    assert not docker.image_exists("env:abc")
+    assert not docker.is_running(cid)
+
+    # ancestor query is filtered server side
+    ps = [r for r in engine.requests if r[1] == "/containers/json"][0]
+    assert json.loads(ps[2]["filters"][0]) == {"ancestor": ["env:abc"]}
+
+    # all requests from this thread went over one persistent connection
+    assert len(engine.connections) == 1
+
+
+def test_api_backend_reconnect(engine, tmp_path):
+    docker = Docker(backend="api", socket=tmp_path / "docker.sock")
+    engine.images.add("env:abc")
+    engine.close_idle = True
+    for _ in range(2):
+        docker.run_container("env:abc")
+        # long enough for the engine to close the idle connection
+        time.sleep(0.2)
+    creates = [r for r in engine.requests if r[1] == "/containers/create"]
+    assert len(creates) == 2 and len(engine.containers) == 2
+
+    # a POST that may have been handled is not sent again
+    engine.close_idle = False
+    engine.drop_posts = True
+    with pytest.raises(ConnectionError):
+        docker.run_container("env:abc")
+    creates = [r for r in engine.requests if r[1] == "/containers/create"]
+    assert len(creates) == 3
+
+
+def test_api_backend_missing_socket(tmp_path):
+    with pytest.raises(ValueError):
+        Docker(backend="api", socket=tmp_path / "missing.sock", mock=False)
+    assert Docker(backend="api", socket=tmp_path / "missing.sock", mock=None).mock
@@ -1,8 +1,28 @@
+import asyncio
+import subprocess
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import pytest
 import requests
 
+from autosmith.cache import ImageCache, artifact_hash
+from autosmith.client import Replica
 from autosmith.docker import Docker
-from autosmith.env import ToolEnv
-from autosmith.smith import smith
+from autosmith.env import ResultCache, ToolEnv
+from autosmith.ready import Readiness
+from autosmith.smith import (
+    _hot_reload,
+    asmith,
+    asmith_envs,
+    smith,
+    smith_envs,
+    smith_many,
+)
+from autosmith.template import encode_tool
+from autosmith.timing import Timer
 
 
 def test_env_url():
@@ -11,6 +31,26 @@ def test_env_url():
     assert str(env.url) == "http://127.0.0.1:8080"
 
 
+def test_requirements_validation():
+    ToolEnv(requirements="numpy==1.19.5\n# comment\n\npytest  # inline comment")
+    with pytest.raises(ValueError):
+        ToolEnv(requirements="numpy==\n")
+
+
+def test_smith_requirements_with_comments():
+    def test():
+        """Test function"""
+        return "hello world"
+
+    env = ToolEnv(
+        requirements="numpy==1.26.0  # pinned",
+        save_dir=None,
+        docker=Docker(mock=True),
+    )
+    env = smith(test, env)
+    assert "test" in env.tools
+
+
 def test_smith():
     def test():
         """Test function"""
@@ -85,3 +125,374 @@ def test_persist_containers():
     env2.close()
 
     assert not docker.is_running(cid) or docker.mock
+
+
+def test_image_cache(tmp_path):
+    def test():
+        """Test function"""
+        return "hello world"
+
+    builds = []
+
+    class CountingDocker(Docker):
+        def build_image(self, image_name, dir):
+            builds.append(image_name)
+
+    docker = CountingDocker(mock=True)
+    cache = ImageCache(path=tmp_path / "images.json")
+
+    env = smith(test, docker=docker, cache=cache)
+    assert len(builds) == 1
+    assert env.image == builds[0]
+    assert env.image.startswith(env.name + ":")
+
+    # identical artifacts are not rebuilt
+    env2 = smith(test, docker=docker, cache=cache)
+    assert len(builds) == 1
+    assert env2.image == env.image
+
+    def test2():
+        """Test function 2"""
+        return "Goodbye world"
+
+    env = smith(test2, env, docker=docker, cache=cache)
+    assert len(builds) == 2
+    assert env.image != env2.image
+
+
+def test_artifact_hash():
+    assert artifact_hash("a", "b") == artifact_hash("a", "b")
+    assert artifact_hash("a", "b") != artifact_hash("b", "a")
+    assert artifact_hash("ab", "") != artifact_hash("a", "b")
+
+
+def test_incremental_build(tmp_path):
+    def test():
+        """Test function"""
+        return "hello world"
+
+    def test2():
+        """Test function 2"""
+        import numpy as np
+
+        return str(np.random.random())
+
+    def test3():
+        """Test function 3"""
+        return "Goodbye world"
+
+    def test4():
+        """Test function 4"""
+        import requests
+
+        return requests.__version__
+
+    dockerfiles = []
+
+    class RecordingDocker(Docker):
+        def build_image(self, image_name, dir):
+            dockerfiles.append((dir / "Dockerfile").read_text())
+
+    docker = RecordingDocker(mock=True)
+    cache = ImageCache(path=tmp_path / "images.json")
+
+    env = smith(test, docker=docker, cache=cache)
+    first_image = env.image
+    assert f"FROM {env.base_image}" in dockerfiles[-1]
+
+    # requirements grew, so build on top of the previous image
+    env = smith(test2, env, docker=docker, cache=cache)
+    assert "numpy" in env.requirements
+    assert f"FROM {first_image}" in dockerfiles[-1]
+    assert env.image_requirements == env.requirements
+
+    # requirements unchanged, so build from the same parent to reuse its layers
+    env = smith(test3, env, docker=docker, cache=cache)
+    assert f"FROM {first_image}" in dockerfiles[-1]
+    assert env.parent_image == first_image
+
+    env = smith(test2, env, docker=docker, cache=cache, incremental=False)
+    assert f"FROM {env.base_image}" in dockerfiles[-1]
+    assert env.parent_image is None
+
+    # the parent was built without these commands, so start from base
+    env.docker_file_commands = "RUN echo hello"
+    env = smith(test4, env, docker=docker, cache=cache)
+    assert "requests" in env.requirements
+    assert f"FROM {env.base_image}" in dockerfiles[-1]
+    assert "RUN echo hello" in dockerfiles[-1]
+
+
+def test_replicas():
+    def test():
+        """Test function"""
+        return "hello world"
+
+    docker = Docker(mock=True)
+    env = ToolEnv(requirements="", replicas=3, workers=2, save_dir=None, docker=docker)
+    env = smith(test, env, docker=docker)
+    assert len(env.containers) == 3
+    assert env.containers[0].port == env.port
+    assert env.container_id == env.containers[0].container_id
+    assert len(env.client().replicas) == 3
+    env.close()
+
+
+def test_readiness():
+    class HealthHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            self.send_response(200 if self.path == "/healthz" else 404)
+            self.end_headers()
+
+        def log_message(self, *args):
+            pass
+
+    class FakeDocker(Docker):
+        running: bool = True
+
+        def is_running(self, cid):
+            return self.running
+
+    # reserve a port, start the server on it a little later
+    server = HTTPServer(("127.0.0.1", 0), HealthHandler)
+    port = server.server_port
+    server.server_close()
+
+    def serve():
+        time.sleep(0.2)
+        late = HTTPServer(("127.0.0.1", port), HealthHandler)
+        late.timeout = 5
+        late.handle_request()
+        late.server_close()
+
+    thread = threading.Thread(target=serve, daemon=True)
+    thread.start()
+    start = time.monotonic()
+    # construct skips the check that docker is installed
+    Readiness(deadline=5).wait(
+        f"http://127.0.0.1:{port}", FakeDocker.construct(mock=False), "cid"
+    )
+    assert time.monotonic() - start < 1
+    thread.join()
+
+    # nothing is listening and the container is gone, so fail before the deadline
+    start = time.monotonic()
+    with pytest.raises(ValueError):
+        Readiness(deadline=5).wait(
+            f"http://127.0.0.1:{port}",
+            FakeDocker.construct(mock=False, running=False),
+            "cid",
+        )
+    assert time.monotonic() - start < 1
+
+
+def test_smith_many(tmp_path):
+    def test():
+        """Test function"""
+        import numpy as np
+
+        return str(np.random.random())
+
+    def test2(x: int):
+        """Test function 2"""
+        return x * 2
+
+    def no_doc():
+        pass
+
+    builds = []
+
+    class CountingDocker(Docker):
+        def build_image(self, image_name, dir):
+            builds.append((dir / "main.py").read_text())
+
+    docker = CountingDocker(mock=True)
+    cache = ImageCache(path=tmp_path / "images.json")
+    env, errors = smith_many([test, no_doc, test2], docker=docker, cache=cache)
+    assert set(env.tools) == {"test", "test2"}
+    assert list(errors) == ["no_doc"]
+    assert isinstance(errors["no_doc"], ValueError)
+    assert "numpy" in env.requirements
+    assert len(builds) == 1
+    assert "def test2(" in builds[0] and "def test(" in builds[0]
+
+    with pytest.raises(ValueError):
+        smith_many([no_doc], docker=docker, cache=cache)
+
+
+def test_import_time():
+    """Loading a saved environment should not import the heavy dependencies"""
+    code = (
+        "import sys, time\n"
+        "start = time.perf_counter()\n"
+        "import autosmith.env, autosmith.smith\n"
+        "print(time.perf_counter() - start)\n"
+        "print(','.join(m for m in {} if m in sys.modules))\n"
+    ).format(
+        ("datamodel_code_generator", "jinja2", "pkg_resources", "importlib_metadata")
+    )
+    output = subprocess.run(
+        [sys.executable, "-c", code], capture_output=True, check=True
+    )
+    seconds, heavy = output.stdout.decode("utf-8").splitlines()
+    assert heavy == ""
+    # generous bound - this is ~0.1 s, the heavy imports alone add ~0.3 s
+    assert float(seconds) < 1.0
+
+
+def test_smith_envs(tmp_path):
+    def test():
+        """Test function"""
+        return "hello world"
+
+    def test2(x: int):
+        """Test function 2"""
+        return x * 2
+
+    def no_doc():
+        pass
+
+    active = []
+    peak = []
+    lock = threading.Lock()
+
+    class SlowDocker(Docker):
+        def build_image(self, image_name, dir):
+            with lock:
+                active.append(image_name)
+                peak.append(len(active))
+            time.sleep(0.05)
+            with lock:
+                active.remove(image_name)
+
+    docker = SlowDocker(mock=True)
+    builds = [test, [test, test2], no_doc, test2, [test2, no_doc]]
+    cache = ImageCache(path=tmp_path / "images.json")
+    results = smith_envs(builds, docker=docker, cache=cache, max_concurrency=2)
+    assert isinstance(results[0], ToolEnv) and set(results[0].tools) == {"test"}
+    assert set(results[1].tools) == {"test", "test2"}
+    assert isinstance(results[2], ValueError)
+    assert isinstance(results[4], ValueError)
+    assert results[3].auto_port and results[3].name != results[0].name
+    assert 0 < max(peak) <= 2
+
+    env = ToolEnv(requirements="", save_dir=tmp_path, docker=docker)
+    results = asyncio.run(asmith_envs([test, no_doc], envs=[env, None], docker=docker))
+    assert results[0] is env and "test" in env.tools
+    assert isinstance(results[1], ValueError)
+
+    results = smith_envs([test2], docker=docker, result_cache=ResultCache(size=8))
+    assert results[0].tools["test2"].result_cache == ResultCache(size=8)
+
+    timer = Timer()
+    env = asyncio.run(
+        asmith(test2, docker=docker, result_cache=ResultCache(), timer=timer)
+    )
+    assert "test2" in env.tools and env.tools["test2"].result_cache == ResultCache()
+    assert env.timings == timer.spans
+
+
+def test_hot_reload(tmp_path):
+    def test():
+        """Test function"""
+        return "hello world"
+
+    def test2(x: int):
+        """Test function 2"""
+        return x * 2
+
+    def test3():
+        """Test function 3"""
+        import numpy as np
+
+        return str(np.random.random())
+
+    posted = []
+
+    class AdminHandler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers["Content-Length"]))
+            posted.append((self.path, self.headers["X-Autosmith-Token"], body))
+            self.send_response(200)
+            self.end_headers()
+            self.wfile.write(b'{"status": "ok"}')
+
+        def log_message(self, *args):
+            pass
+
+    server = HTTPServer(("127.0.0.1", 0), AdminHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    builds = []
+
+    class FakeDocker(Docker):
+        def build_image(self, image_name, dir):
+            builds.append(image_name)
+
+        def is_running(self, cid):
+            return True
+
+    docker = FakeDocker.construct(mock=False)
+    env = ToolEnv(
+        requirements="",
+        tools={},
+        image="tool-environment:abc",
+        image_requirements="",
+        containers=[Replica(container_id="cid", port=server.server_port)],
+        save_dir=tmp_path,
+        docker=docker,
+    )
+    env.deployed_settings = env.settings_hash()
+    env = smith(test, env, docker=docker)
+    env = smith(test2, env, docker=docker)
+    server.shutdown()
+    assert builds == []
+    assert set(env.tools) == {"test", "test2"}
+    assert [p[0] for p in posted] == ["/_admin/tools"] * 2
+    assert posted[0][1] == env.admin_token
+    assert b"def test2(" in posted[1][2]
+
+    # new requirements need a new image
+    assert not _hot_reload(env, encode_tool(test3), "numpy", docker)
+    # as do settings changed since the containers were started
+    env.rpc = True
+    assert not _hot_reload(env, encode_tool(test2), "", docker)
+    env.rpc = False
+    env.workers = 2
+    assert not _hot_reload(env, encode_tool(test2), "", docker)
+
+
+def test_timings(tmp_path):
+    def test():
+        """Test function"""
+        return "hello world"
+
+    seen = []
+    docker = Docker(mock=True)
+    cache = ImageCache(path=tmp_path / "images.json")
+    timer = Timer(on_span=seen.append, profile=True)
+    env = smith(test, docker=docker, cache=cache, timer=timer)
+    names = [s.name for s in env.timings]
+    assert names == [
+        "requirements",
+        "schema",
+        "render",
+        "render_image",
+        "build",
+        "start",
+        "ready",
+    ]
+    assert seen == env.timings == timer.spans
+    assert all(s.duration >= 0 for s in env.timings)
+    assert set(timer.totals()) == set(names)
+    # the profile covers the python phases, e.g. rendering
+    assert any("render_main" in f[2] for f in timer.stats().stats)
+
+    # cached image, so nothing is built, and timings are only of this call
+    env = smith(test, docker=docker, cache=cache, timer=timer)
+    assert "build" not in [s.name for s in env.timings]
+    assert len(timer.spans) == len(names) + len(env.timings)
+
+    with pytest.raises(ValueError):
+        Timer().stats()
@@ -1,14 +1,22 @@
+import inspect
+import sys
 from math import *  # noqa
 
+import importlib_metadata
 import pytest
 from numpy import arange
 
+from autosmith import cache
+from autosmith import func as func_module
 from autosmith.func import (
+    clear_distribution_cache,
     consistent_requirements,
     get_func_imports,
     get_imports,
+    get_module_imports,
     get_requirements_from_imports,
     merge_requirements,
+    requirement_lines,
 )
 
 
@@ -103,6 +111,20 @@ def test_consistent_requirements():
     assert not consistent_requirements(env, proposed)
 
 
+def test_requirements_with_comments():
+    env = """
+    # pinned for the tests
+    numpy==1.19.5  # inline comment
+    pytest==6.2.2\t# after a tab
+
+    """
+    assert requirement_lines(env) == ["numpy==1.19.5", "pytest==6.2.2"]
+    assert consistent_requirements(env, "numpy==1.19.5")
+    assert merge_requirements("numpy==1.19.5  # pinned", "pytest") == (
+        "numpy==1.19.5\npytest"
+    )
+
+
 def test_str_func():
     get_func_imports("def foo(): pass")
 
@@ -130,3 +152,65 @@ def test_merge_requirements():
     """
 
     assert consistent_requirements(env + "\nrdkit", merge_requirements(env, proposed))
+
+
+def test_distribution_cache(monkeypatch, tmp_path):
+    calls = []
+    scan = importlib_metadata.packages_distributions
+
+    def counting_scan():
+        calls.append(1)
+        return scan()
+
+    monkeypatch.setattr(importlib_metadata, "packages_distributions", counting_scan)
+    clear_distribution_cache()
+    get_requirements_from_imports(["numpy"])
+    reqs = get_requirements_from_imports(["numpy"])
+    assert reqs == f"numpy=={importlib_metadata.version('numpy')}"
+    assert len(calls) == 1
+
+    # changing sys.path invalidates
+    (tmp_path / "site").mkdir()
+    monkeypatch.syspath_prepend(str(tmp_path / "site"))
+    get_requirements_from_imports(["numpy"])
+    assert len(calls) == 2
+
+    # persisted copy is reused by a fresh process (simulated by clearing memory)
+    monkeypatch.setattr(cache, "_cache_dir", tmp_path / "cache")
+    clear_distribution_cache()
+    get_requirements_from_imports(["numpy"])
+    assert len(calls) == 3
+    assert len(list((tmp_path / "cache").glob("distributions-*.json"))) == 1
+    clear_distribution_cache()
+    assert get_requirements_from_imports(["numpy"]) == reqs
+    assert len(calls) == 3
+
+
+def test_module_imports_cache(monkeypatch):
+    parses = []
+    parse = get_imports
+
+    def counting_parse(source):
+        parses.append(1)
+        return parse(source)
+
+    monkeypatch.setattr(func_module, "get_imports", counting_parse)
+    func_module._module_imports.clear()
+
+    def func():
+        arange(3)
+
+    def func2():
+        pytest.main()
+
+    assert get_func_imports(func) == ["math", "numpy"]
+    assert get_func_imports(func2) == ["math", "pytest"]
+    assert len(parses) == 1
+    assert get_module_imports(__name__) == parse(
+        inspect.getsource(sys.modules[__name__])
+    )
+
+    monkeypatch.setattr(func_module, "MODULE_CACHE_SIZE", 0)
+    func_module._module_imports.clear()
+    get_func_imports(func)
+    assert len(func_module._module_imports) == 0
@@ -0,0 +1,167 @@
+import json
+import subprocess
+
+import pytest
+import requests
+
+from autosmith import local
+from autosmith.env import ToolEnv
+from autosmith.local import LocalRuntime, _image_command
+from autosmith.runtime import Runtime
+from autosmith.smith import smith
+from autosmith.template import render_container
+
+
+def test_image_command():
+    env = ToolEnv(requirements="", workers=3, save_dir=None)
+    command = _image_command(render_container(env))
+    assert command[:2] == ["uvicorn", "main:app"]
+    assert command[command.index("--workers") + 1] == "3"
+    assert command[command.index("--port") + 1] == "8080"
+
+
+def test_runtime_is_abstract():
+    with pytest.raises(TypeError):
+        Runtime()
+
+
+def test_local_runtime(tmp_path):
+    pytest.importorskip("fastapi")
+    pytest.importorskip("uvicorn")
+
+    def double(x: int):
+        """Double x"""
+        return 2 * x
+
+    def triple(x: int):
+        """Triple x"""
+        return 3 * x
+
+    def quadruple(x: int):
+        """Quadruple x"""
+        return 4 * x
+
+    runtime = LocalRuntime(root=tmp_path / "local")
+    env = ToolEnv(requirements="", port=0, save_dir=tmp_path, docker=runtime)
+    env = smith(double, env)
+    assert runtime.image_exists(env.image)
+    cid = env.container_id
+    assert runtime.is_running(cid)
+    assert requests.get(f"{env.url}/double", params={"x": 2}).json() == 4
+
+    # added to the running server without starting a new process
+    env = smith(triple, env)
+    assert env.container_id == cid
+    assert requests.get(f"{env.url}/triple", params={"x": 2}).json() == 6
+
+    # other settings changed, so the containers are replaced
+    env.replicas = 2
+    env = smith(quadruple, env)
+    assert len(env.containers) == 2 and not runtime.is_running(cid)
+    cid = env.container_id
+    assert requests.get(f"{env.url}/quadruple", params={"x": 2}).json() == 8
+
+    env.save()
+    loaded = ToolEnv.load(env.name, save_dir=tmp_path)
+    assert loaded.url == env.url
+    assert isinstance(loaded.docker, LocalRuntime)
+    # as if loaded by another interpreter, which did not start the processes
+    processes = [local._processes.pop(r.container_id) for r in loaded.containers]
+    assert runtime.is_running(cid)
+    assert runtime.container_port(cid) == loaded.port
+    loaded.close()
+    assert all(p.wait(timeout=5) is not None for p in processes)
+    assert not runtime.is_running(cid)
+
+
+def test_local_reused_pid(tmp_path):
+    runtime = LocalRuntime(root=tmp_path / "local")
+    # a process that reuses the pid of a server that exited long ago
+    process = subprocess.Popen(["sleep", "30"], start_new_session=True)
+    cid = str(process.pid)
+    pid_file = tmp_path / "local" / "pids" / f"{cid}.json"
+    pid_file.parent.mkdir(parents=True)
+    pid_file.write_text(json.dumps({"start": "0", "port": 8080}))
+    try:
+        assert not runtime.is_running(cid)
+        runtime.remove_container(cid)
+        assert process.poll() is None
+    finally:
+        process.kill()
+        process.wait()
+
+
+def test_local_encodings(tmp_path):
+    pytest.importorskip("fastapi")
+    pytest.importorskip("uvicorn")
+    pytest.importorskip("msgpack")
+    numpy = pytest.importorskip("numpy")
+
+    def total(x: numpy.ndarray, scale: float):  # type: ignore[name-defined]
+        """Scaled sum of x"""
+        return x.sum() * scale
+
+    runtime = LocalRuntime(root=tmp_path / "local")
+    env = ToolEnv(requirements="", port=0, save_dir=None, docker=runtime)
+    env = smith(total, env)
+    client = env.client()
+    x = numpy.arange(1000, dtype=numpy.float64)
+    assert client.post("total", {"x": x, "scale": 2}, encoding="msgpack") == 999000
+    assert client.post("total", {"x": [1, 2], "scale": 2}) == 6
+    # query arguments are strings, parsed as numbers
+    params = {"x": [1, 2, 3], "scale": 1}
+    assert requests.get(f"{env.url}/total", params=params).json() == 6
+    params = {"x": ["a"], "scale": 1}
+    assert requests.get(f"{env.url}/total", params=params).status_code == 422
+    env.close()
+
+
+def test_local_stream(tmp_path):
+    pytest.importorskip("fastapi")
+    pytest.importorskip("uvicorn")
+
+    def count(n: int):
+        """Count to n, failing at 3"""
+        for i in range(n):
+            if i == 3:
+                raise ValueError("three")
+            yield {"i": i}
+
+    runtime = LocalRuntime(root=tmp_path / "local")
+    env = ToolEnv(requirements="", port=0, save_dir=None, docker=runtime)
+    env = smith(count, env)
+    client = env.client()
+    assert list(client.stream("count", {"n": 2})) == [{"i": 0}, {"i": 1}]
+    r = requests.get(f"{env.url}/count", params={"n": 2})
+    assert r.headers["content-type"] == "application/x-ndjson"
+    assert r.text == '{"i": 0}\n{"i": 1}\n'
+    with pytest.raises(ValueError):
+        list(client.stream("count", {"n": 5}))
+    env.close()
+
+
+def test_local_rpc(tmp_path):
+    pytest.importorskip("fastapi")
+    pytest.importorskip("uvicorn")
+    pytest.importorskip("websockets")
+
+    def add(a: int, b: int):
+        """Add a and b"""
+        if a < 0:
+            raise ValueError("negative")
+        return a + b
+
+    runtime = LocalRuntime(root=tmp_path / "local")
+    env = ToolEnv(requirements="", port=0, save_dir=None, rpc=True, docker=runtime)
+    env = smith(add, env)
+    with env.client().rpc() as rpc:
+        futures = [rpc.submit("add", {"a": i, "b": 1}) for i in range(20)]
+        assert [f.result() for f in futures] == list(range(1, 21))
+        assert rpc.call("add", a=1, b=2) == 3
+        with pytest.raises(ValueError, match="500"):
+            rpc.call("add", a=-1, b=2)
+        with pytest.raises(ValueError, match="404"):
+            rpc.call("missing")
+    # POST takes the input as a JSON body
+    assert requests.post(f"{env.url}/add", json={"a": 1, "b": 2}).json() == 3
+    env.close()
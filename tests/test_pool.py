@@ -0,0 +1,98 @@
+import itertools
+
+import pytest
+
+from autosmith.cache import ImageCache
+from autosmith.docker import Docker
+from autosmith.env import ToolEnv
+from autosmith.pool import WarmPool
+from autosmith.smith import smith
+
+ids = itertools.count()
+
+
+class CountingDocker(Docker):
+    def run_container(self, image_name, port=None, environment=None):
+        cid = f"{image_name}-{next(ids)}"
+        self.__dict__.setdefault("started", []).append(cid)
+        self.__dict__.setdefault("environments", {})[cid] = environment
+        return cid
+
+    def remove_container(self, cid):
+        self.__dict__.setdefault("removed", []).append(cid)
+
+
+def test_warm_pool():
+    docker = CountingDocker(mock=True)
+    with WarmPool(size=2, docker=docker) as pool:
+        # nothing is warm yet, but asking starts filling
+        assert pool.take("image") is None
+        pool.fill("image")
+        assert pool.warm("image") == 2
+
+        replica = pool.take("image")
+        assert replica.container_id in docker.started
+        pool.fill("image")
+        assert pool.warm("image") == 2
+        assert len(docker.started) == 3
+
+    assert pool.warm("image") == 0
+    assert len(docker.removed) == 2
+    assert replica.container_id not in docker.removed
+
+
+def test_evict_idle():
+    docker = CountingDocker(mock=True)
+    pool = WarmPool(size=1, idle_timeout=1000, docker=docker)
+    pool.fill("image")
+    assert pool.evict_idle() == 0
+    pool.idle_timeout = 0
+    # a full pool ignores refills, so the image was last used when first filled
+    assert pool.evict_idle() == 1
+    assert pool.warm("image") == 0
+    pool.close()
+
+
+def test_smith_warm_pool(tmp_path):
+    def test():
+        """Test function"""
+        return "hello world"
+
+    docker = CountingDocker(mock=True)
+    env = ToolEnv(requirements="", port=0, save_dir=tmp_path, docker=docker)
+    env = smith(test, env, docker=docker)
+    with WarmPool(size=1, docker=docker) as pool:
+        pool.fill(env.image)
+        warm = docker.started[-1]
+
+        env2 = ToolEnv(requirements="", port=0, save_dir=tmp_path)
+        env2 = smith(test, env2, docker=docker, warm_pool=pool)
+        assert env2.image == env.image
+        # the warm container was handed out instead of starting one
+        assert env2.container_id == warm
+        # and knows the token smith uses to add tools to it
+        token = docker.environments[warm]["AUTOSMITH_ADMIN_TOKEN"]
+        assert env2.admin_token == token == pool.admin_token
+
+
+def test_smith_warm_pool_default_env(tmp_path):
+    def test():
+        """Test function"""
+        return "hello world"
+
+    docker = CountingDocker(mock=True)
+    cache = ImageCache(path=tmp_path / "images.json")
+    with WarmPool(size=1, docker=docker) as pool:
+        env = smith(test, docker=docker, cache=cache, warm_pool=pool)
+        assert env.auto_port
+        pool.fill(env.image)
+        warm = list(docker.started)
+        env = smith(test, docker=docker, cache=cache, warm_pool=pool)
+        # started by the pool before, not cold started
+        assert env.container_id in warm
+        env.close()
+
+        # a fixed port cannot come from the pool
+        env = ToolEnv(requirements="", save_dir=tmp_path, docker=docker)
+        with pytest.warns(UserWarning, match="warm_pool"):
+            smith(test, env, docker=docker, warm_pool=pool)
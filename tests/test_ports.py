@@ -0,0 +1,94 @@
+import socket
+
+import pytest
+
+from autosmith.docker import Docker
+from autosmith.env import ToolEnv
+from autosmith.ports import PortRegistry, port_is_free
+from autosmith.smith import smith
+
+
+def test_port_registry(tmp_path):
+    registry = PortRegistry(path=tmp_path / "ports.json")
+    assert registry.owners() == {}
+
+    registry.register(8080, "env-a")
+    assert registry.owner(8080) == "env-a"
+    # another registry on the same file sees the same ports
+    assert PortRegistry(path=tmp_path / "ports.json").owner(8080) == "env-a"
+
+    # only the owner releases a port when given
+    registry.release(8080, owner="env-b")
+    assert registry.owner(8080) == "env-a"
+    registry.release(8080, owner="env-a")
+    assert registry.owner(8080) is None
+
+
+def test_prune(tmp_path):
+    registry = PortRegistry(path=tmp_path / "ports.json")
+    registry.register(0, "env-a")
+
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        sock.listen()
+        port = sock.getsockname()[1]
+        assert not port_is_free(port)
+        registry.register(port, "env-b")
+        # nothing listens on port 0
+        removed = registry.prune()
+        assert removed == {0: "env-a"}
+        assert registry.owners() == {port: "env-b"}
+
+
+def test_auto_port(tmp_path):
+    def test():
+        """Test function"""
+        return "hello world"
+
+    ports = iter([32768, 32769, 32770])
+
+    class EphemeralDocker(Docker):
+        def container_port(self, cid):
+            return next(ports)
+
+    docker = EphemeralDocker(mock=True)
+    env = ToolEnv(requirements="", port=0, replicas=2, save_dir=tmp_path, docker=docker)
+    assert env.auto_port
+    env = smith(test, env, docker=docker)
+    assert [r.port for r in env.containers] == [32768, 32769]
+    assert env.port == 32768
+    assert env.url == f"http://{env.host}:32768"
+    registry = env.port_registry()
+    owner = env.port_owner()
+    assert owner.startswith(env.name)
+    assert registry.owners() == {32768: owner, 32769: owner}
+
+    # rebuilding releases the old ports
+    env.replicas = 1
+    env = smith(test, env, docker=docker)
+    assert registry.owners() == {32770: owner}
+    env.close()
+    assert registry.owners() == {}
+
+
+def test_same_name_owners(tmp_path):
+    def test():
+        """Test function"""
+        return "hello world"
+
+    docker = Docker(mock=True)
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        # stands in for the server of the first environment
+        sock.bind(("127.0.0.1", 0))
+        sock.listen()
+        port = sock.getsockname()[1]
+        env = ToolEnv(requirements="", port=port, save_dir=tmp_path, docker=docker)
+        env = smith(test, env, docker=docker)
+        other = ToolEnv(requirements="", port=port, save_dir=tmp_path, docker=docker)
+        assert other.name == env.name
+        with pytest.raises(ValueError, match="is used by"):
+            smith(test, other, docker=docker)
+        # closing the other environment leaves the first one's port registered
+        other.containers = env.containers
+        other.close()
+        assert env.port_registry().owner(port) == env.port_owner()
@@ -1,15 +1,24 @@
 import ast
+from typing import List
 
 import pytest
+from datamodel_code_generator.parser import jsonschema
 from pydantic import BaseModel
 
-from autosmith.env import ToolEnv
+from autosmith import cache, template
+from autosmith.env import ResultCache, ToolEnv
 from autosmith.template import (
+    compile_schema,
     func_to_url,
     get_func_description,
+    get_func_executor,
     get_func_name,
+    get_func_streams,
     make_schema,
+    quote_annotations,
     render_container,
+    render_main,
+    render_requirements,
     render_server,
 )
 
@@ -53,6 +62,45 @@ def test_make_schema_imports():
     assert schema.schema() == Func.schema()
 
 
+def test_make_schema_arrays():
+    numpy = pytest.importorskip("numpy")
+
+    def func(x: numpy.ndarray, data: bytes) -> float:  # type: ignore[name-defined]
+        """Sum of x"""
+        return float(x.sum())
+
+    schema = make_schema(func)
+    assert schema.schema()["properties"]["x"]["format"] == "ndarray"
+    # arrays are passed through, not validated element by element
+    x = numpy.arange(3)
+    assert schema(x=x, data=b"").x is x
+
+    tool_env = ToolEnv(requirements="", msgpack=True)
+    rendered = render_server(func, tool_env=tool_env)
+    assert is_valid_python(rendered)
+    assert tool_env.tools["func"].arrays == ["x"]
+    assert "_with_arrays(dict(input), ['x'])" in rendered
+    assert '@app.post("/func", openapi_extra' in rendered
+    assert "msgpack" in render_requirements(tool_env).splitlines()
+    # annotations are not evaluated by the server, which may not import numpy
+    assert "def func(x: 'numpy.ndarray', data: 'bytes') -> 'float':" in rendered
+    assert "numpy" in render_requirements(tool_env).splitlines()
+    tool_env.requirements = "numpy==1.26.0"
+    assert "numpy" not in render_requirements(tool_env).splitlines()
+
+
+def test_quote_annotations():
+    source = (
+        "def f(a: np.ndarray, *args: int, b: 'str' = 'x',\n"
+        "      c: Dict[str,\n  int] = {}) -> pd.DataFrame:\n    return a"
+    )
+    assert quote_annotations(source) == (
+        "def f(a: 'np.ndarray', *args: 'int', b: 'str' = 'x',\n"
+        "      c: 'Dict[str, int]' = {}) -> 'pd.DataFrame':\n    return a"
+    )
+    assert quote_annotations("x = 1") == "x = 1"
+
+
 def test_empty_schema():
     """Test with callable function and make sure schema is empty"""
 
@@ -85,6 +133,131 @@ def test_get_func_description():
     assert get_func_description(func) == "Add a and b"
 
 
+def test_get_func_executor():
+    def func(a: int) -> int:
+        """Double a"""
+        return 2 * a
+
+    async def afunc(a: int) -> int:
+        """Double a"""
+        return 2 * a
+
+    assert get_func_executor(func) == "thread"
+    assert get_func_executor(afunc) == "async"
+    assert get_func_executor("async def foo():\n    pass") == "async"
+    assert get_func_name("async def foo():\n    pass") == "foo"
+
+
+def test_get_func_streams():
+    def gen(n: int):
+        """Count to n"""
+        yield from range(n)
+
+    async def agen(n: int):
+        """Count to n"""
+        for i in range(n):
+            yield i
+
+    def func(n: int):
+        """Count to n"""
+        return [i for i in range(n)]
+
+    assert get_func_streams(gen)
+    assert get_func_streams(agen)
+    assert get_func_executor(agen) == "async"
+    assert not get_func_streams(func)
+    assert get_func_streams("def foo():\n    yield 1")
+    # yields of nested functions do not count
+    assert not get_func_streams(
+        "def foo():\n    def bar():\n        yield 1\n    return bar"
+    )
+
+    tool_env = ToolEnv(requirements="")
+    rendered = render_server(gen, tool_env=tool_env)
+    assert is_valid_python(rendered)
+    assert tool_env.tools["gen"].stream
+    assert "return _encode_stream(request" in rendered
+    assert "/gen/batch" not in rendered
+    with pytest.raises(ValueError):
+        render_server(gen, result_cache=ResultCache())
+    with pytest.raises(ValueError):
+        render_server(gen, executor="process")
+
+
+def test_template_server_executor():
+    """Test async functions are awaited and executor can be chosen"""
+
+    func = """
+    async def func(a: int, b: float) -> int:
+        '''Add a and b'''
+        return int(a + b)
+    """
+    schema = """
+    class Schema(BaseModel):
+        a: int
+        b: float
+    """
+    rendered = render_server(func, schema)
+    assert is_valid_python(rendered)
+    assert "return await func(" in rendered
+
+    tool_env = ToolEnv(requirements="")
+    rendered = render_server(
+        func.replace("async ", ""), schema, tool_env=tool_env, executor="process"
+    )
+    assert is_valid_python(rendered)
+    assert tool_env.tools["func"].executor == "process"
+    assert "_get_process_pool()" in rendered
+
+
+def test_template_server_result_cache():
+    def double(x: int):
+        """Double x"""
+        return 2 * x
+
+    def triple(x: int):
+        """Triple x"""
+        return 3 * x
+
+    tool_env = ToolEnv(requirements="")
+    render_server(double, tool_env=tool_env, result_cache=ResultCache(size=8, ttl=60))
+    rendered = render_server(triple, tool_env=tool_env)
+    assert is_valid_python(rendered)
+    assert tool_env.tools["double"].result_cache.size == 8
+    assert '_result_caches["double"] = _ResultCache(8, 60.0)' in rendered
+    assert '_result_caches["triple"]' not in rendered.replace(
+        '_result_caches.pop("triple", None)', ""
+    )
+
+    with pytest.raises(ValueError):
+        ResultCache(size=0)
+
+
+def test_template_server_metrics():
+    def double(x: int):
+        """Double x"""
+        return 2 * x
+
+    tool_env = ToolEnv(requirements="")
+    rendered = render_server(double, tool_env=tool_env)
+    assert "/metrics" not in rendered
+    assert "_timed" not in rendered
+
+    def metrics(x: int):
+        """Shadows /metrics"""
+        return x
+
+    with pytest.raises(ValueError):
+        render_server(metrics, tool_env=tool_env)
+
+    tool_env.metrics = True
+    rendered = render_main(tool_env)
+    assert is_valid_python(rendered)
+    assert '@app.get("/metrics"' in rendered
+    assert "run_in_threadpool(_timed, double" in rendered
+    assert '_metrics.setdefault("double", _ToolMetrics())' in rendered
+
+
 def test_func_to_url():
     assert func_to_url("foo_bar") == "foo-bar"
 
@@ -134,6 +307,7 @@ def test_template_server_infer():
     rendered = render_server(func)
     assert is_valid_python(rendered)
     assert "Func(BaseModel):" in rendered
+    assert '@app.post("/func/batch")' in rendered
 
 
 def test_template_server_fail():
@@ -159,3 +333,103 @@ def test_template_container():
     tool_env = ToolEnv(requirements="pytest==6.2.2")
     rendered = render_container(tool_env)
     assert str(tool_env.port) in rendered
+
+
+def test_compile_schema_nested():
+    class Point(BaseModel):
+        x: float
+        y: float
+
+    def centroid(points: List[Point], label: str):
+        """Centroid of points"""
+        return sum(p.x for p in points) / len(points)
+
+    tool_env = ToolEnv(requirements="")
+    render_server(centroid, tool_env=tool_env)
+    raw = tool_env.tools["centroid"].input_class_raw_schema
+    # nested models come first, so the generated module runs
+    assert raw.index("class Point(") < raw.index("class Centroid(")
+    namespace = {}
+    exec("from typing import *\nfrom pydantic import *\n" + raw, namespace)
+    model = namespace["Centroid"](points=[{"x": 1, "y": 2}], label="a")
+    assert model.points[0].y == 2
+
+
+def test_compile_schema_cache(monkeypatch, tmp_path):
+    parsers = []
+
+    class CountingParser(jsonschema.JsonSchemaParser):
+        def __init__(self, *args, **kwargs):
+            parsers.append(1)
+            super().__init__(*args, **kwargs)
+
+    monkeypatch.setattr(jsonschema, "JsonSchemaParser", CountingParser)
+    monkeypatch.setattr(template, "_compiled_schemas", {})
+
+    def func(a: int, b: float) -> int:
+        """Add a and b"""
+        return int(a + b)
+
+    raw = compile_schema(make_schema(func).schema_json())
+    assert "class Func(BaseModel):" in raw
+    render_server(func)
+    assert len(parsers) == 1
+
+    # on disk cache survives the in-memory one
+    monkeypatch.setattr(cache, "_cache_dir", tmp_path)
+    monkeypatch.setattr(template, "_compiled_schemas", {})
+    assert compile_schema(make_schema(func).schema_json()) == raw
+    assert len(parsers) == 2
+    monkeypatch.setattr(template, "_compiled_schemas", {})
+    assert compile_schema(make_schema(func).schema_json()) == raw
+    assert len(parsers) == 2
+    assert len(list((tmp_path / "schemas").glob("*.py"))) == 1
+
+
+def test_render_tool_incremental(tmp_path, monkeypatch):
+    def func(a: int, b: float) -> int:
+        """Add a and b"""
+        return int(a + b)
+
+    def func2(a: int) -> int:
+        """Double a"""
+        return 2 * a
+
+    tool_env = ToolEnv(requirements="")
+    render_server(func, tool_env=tool_env)
+    tool = tool_env.tools["func"]
+    block = tool._rendered[1]
+    assert "async def func_get(" in block
+
+    rendered = []
+    env = template.get_jinja_env()
+    assert template.get_jinja_env() is env
+    tool_template = env.get_template("tool.py.jinja")
+
+    class CountingTemplate:
+        def render(self, **kwargs):
+            rendered.append(kwargs["endpoint"])
+            return tool_template.render(**kwargs)
+
+    monkeypatch.setattr(
+        env,
+        "get_template",
+        lambda name: CountingTemplate()
+        if name == "tool.py.jinja"
+        else type(env).get_template(env, name),
+    )
+    main = render_server(func2, tool_env=tool_env)
+    # only the new tool was rendered
+    assert rendered == ["func2"]
+    assert is_valid_python(main)
+    assert block in main
+
+    # changing a tool re-renders it
+    tool.executor = "process"
+    render_main(tool_env)
+    assert rendered == ["func2", "func"]
+
+    # bytecode cache is used when a cache dir is set
+    monkeypatch.setattr(cache, "_cache_dir", tmp_path)
+    template.get_jinja_env().get_template("Dockerfile.jinja")
+    assert list((tmp_path / "jinja").iterdir())